@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+'''
+    Benchmarks sync.py without touching github.com.
+    Serves a fake GitHub GraphQL endpoint, generates local bare remotes that stand in for
+    `git@github.com:` URLs and replays push webhooks against the sync server.
+'''
+
+__version__ = '0.1.0'
+__license__ = 'GPLv3+'
+
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import http.server
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import signal
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+
+import sync
+
+DEFAULT_SIZES = '100,1000,5000'
+DEFAULT_DISTRIBUTION = 'apertium-trunk:30,apertium-staging:20,apertium-nursery:20,apertium-incubator:20,apertium-languages:5,apertium-tools:4,apertium-core:1'
+DEFAULT_EVENTS = 50
+DEFAULT_CONCURRENCY = 8
+DEFAULT_HISTORIES = '1,100'
+DEFAULT_BLOB_SIZE = 16 * 1024  # bytes
+PAGE_SIZE = 100
+
+push_locks = collections.defaultdict(threading.Lock)
+
+
+class FakeGitHub:
+    def __init__(self, remotes_dir, repos):
+        self.remotes_dir = remotes_dir
+        self.repos = repos
+        self.requests = 0
+        self.connections = 0
+        self.not_modified = 0
+        self.faults = collections.deque()
+
+    def node(self, name, topics):
+        return {
+            'id': 'R_{}'.format(name),
+            'name': name,
+            'description': None,
+            'master': {'target': {'oid': self.head(name)}},
+            'repositoryTopics': {'nodes': list(map(lambda topic: {'topic': {'name': topic}}, topics))},
+        }
+
+    def head(self, name):
+        with open(os.path.join(self.remotes_dir, '{}.git'.format(name), 'refs', 'heads', 'master')) as ref_file:
+            return ref_file.read().strip()
+
+    def page(self, query):
+        after = re.search(r'after: "(\d+)"', query)
+        start = int(after.group(1)) if after else 0
+        names = list(self.repos.keys())[start:start + PAGE_SIZE]
+        end = start + len(names)
+        return {'data': {'organization': {'repositories': {
+            'edges': list(map(lambda name: {'node': self.node(name, self.repos[name])}, names)),
+            'pageInfo': {'endCursor': str(end), 'hasNextPage': end < len(self.repos)},
+        }}}}
+
+    def rest_page(self, query):
+        params = urllib.parse.parse_qs(query)
+        per_page, page = int(params['per_page'][0]), int(params['page'][0])
+        names = sorted(self.repos.keys())[(page - 1) * per_page:page * per_page]
+        return list(map(lambda name: {'name': name, 'description': None, 'topics': self.repos[name], 'visibility': 'public'}, names))
+
+    def fault(self):
+        try:
+            return self.faults.popleft()
+        except IndexError:
+            return None
+
+
+# Faults are taken from FakeGitHub.faults, one per request: a 502, a secondary rate limit or a
+# GraphQL RATE_LIMITED error.
+class FakeGitHubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.github.connections += 1
+
+    def do_GET(self):
+        github = self.server.github
+        github.requests += 1
+        if self.send_fault(github.fault()):
+            return
+        url = urllib.parse.urlsplit(self.path)
+        body = json.dumps(github.rest_page(url.query)).encode('utf-8')
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            github.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_json(200, body, {'ETag': etag})
+
+    def do_POST(self):
+        github = self.server.github
+        github.requests += 1
+        length = int(self.headers['Content-Length'])
+        query = json.loads(self.rfile.read(length).decode('utf-8'))['query']
+        if not self.send_fault(github.fault()):
+            self.send_json(200, json.dumps(github.page(query)).encode('utf-8'))
+
+    def send_fault(self, fault):
+        if fault == '502':
+            self.send_json(502, b'{}')
+        elif fault == '403':
+            self.send_json(403, json.dumps({'message': 'You have exceeded a secondary rate limit.'}).encode('utf-8'), {'Retry-After': '1'})
+        elif fault == 'RATE_LIMITED':
+            self.send_json(200, json.dumps({'errors': [{'type': 'RATE_LIMITED', 'message': 'API rate limit exceeded'}]}).encode('utf-8'))
+        return fault is not None
+
+    def send_json(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGitHubServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, github):
+        super().__init__(('127.0.0.1', 0), FakeGitHubHandler)
+        self.github = github
+
+
+def git(*args, cwd=None, input=None):
+    return subprocess.run(('git',) + args, cwd=cwd, input=input, stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout.strip()
+
+
+def configure_git(root, remotes_dir):
+    config_path = os.path.join(root, 'gitconfig')
+    os.environ['GIT_CONFIG_GLOBAL'] = config_path
+    os.environ['GIT_CONFIG_NOSYSTEM'] = '1'
+    git('config', '--global', 'url.file://{}/.insteadOf'.format(remotes_dir), 'git@github.com:{}/'.format(sync.ORGANIZATION))
+    git('config', '--global', 'protocol.file.allow', 'always')
+    git('config', '--global', 'uploadpack.allowFilter', 'true')
+    git('config', '--global', 'user.name', 'Benchmark')
+    git('config', '--global', 'user.email', 'benchmark@localhost')
+
+
+def create_remotes(remotes_dir, names):
+    template = os.path.join(remotes_dir, '.template.git')
+    git('init', '--quiet', '--bare', template)
+    blob = git('hash-object', '-w', '--stdin', cwd=template, input='benchmark\n')
+    tree = git('mktree', cwd=template, input='100644 blob {}\tREADME\n'.format(blob))
+    commit = git('commit-tree', tree, '-m', 'Initial commit', cwd=template)
+    git('update-ref', 'refs/heads/master', commit, cwd=template)
+    for name in names:
+        shutil.copytree(template, os.path.join(remotes_dir, '{}.git'.format(name)))
+    shutil.rmtree(template)
+
+
+def push_commit(remotes_dir, name):
+    remote = os.path.join(remotes_dir, '{}.git'.format(name))
+    with push_locks[name]:
+        before = git('rev-parse', 'master', cwd=remote)
+        commit = git('commit-tree', 'master^{tree}', '-p', before, '-m', 'Benchmark {}'.format(uuid.uuid4()), cwd=remote)
+        git('update-ref', 'refs/heads/master', commit, before, cwd=remote)
+    return before, commit
+
+
+def grow_history(remotes_dir, name, commits, blob_size, seed):
+    # Each commit replaces a file with incompressible random content, so the history and the packs
+    # of the remote grow with the commit count.
+    remote = os.path.join(remotes_dir, '{}.git'.format(name))
+    rng = random.Random('{}:{}'.format(seed, name))
+    with push_locks[name]:
+        stream = bytearray()
+        for i in range(commits):
+            message = 'Benchmark history {}'.format(i)
+            stream += 'commit refs/heads/master\ncommitter Benchmark <benchmark@localhost> {} +0000\ndata {}\n{}\n'.format(
+                int(time.time()), len(message), message,
+            ).encode('utf-8')
+            if i == 0:
+                stream += 'from {}\n'.format(git('rev-parse', 'master', cwd=remote)).encode('utf-8')
+            stream += 'M 100644 inline history.bin\ndata {}\n'.format(blob_size).encode('utf-8') + rng.randbytes(blob_size) + b'\n'
+        subprocess.run(['git', 'fast-import', '--quiet'], cwd=remote, input=bytes(stream), check=True)
+
+
+def generate_repos(size, distribution, seed):
+    rng = random.Random(seed)
+    topics, weights = zip(*distribution)
+    repos = collections.OrderedDict()
+    for name in collections.ChainMap(*sync.METAREPOS):
+        repos[name] = ['apertium-all'] if name != 'apertium-all' else []
+    for i in range(size):
+        repos['apertium-bench{:05d}'.format(i)] = [rng.choices(topics, weights)[0]]
+    return repos
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+def report(size, path, metric, value):
+    print('{:>6}  {:<44}  {:<24}  {:>10.3f}'.format(size, path, metric, value), flush=True)
+
+
+def bench_sync(args, root, github, size):
+    clone_dir = os.path.join(root, 'sync')
+    os.makedirs(clone_dir)
+    sync_args = sync.parse_args(['sync', '--dir', clone_dir, '--token', 'benchmark'] + (['--bare'] if args.bare else []))
+    name = args.metarepo
+
+    def run():
+        repos_by_topic = sync.group_repos_by_topic(sync.iter_repos(sync_args.token))
+        submodules = sync.repos_for_topics(repos_by_topic, collections.ChainMap(*sync.METAREPOS)[name])
+        start = time.monotonic()
+        sync.metarepo_syncer(sync_args, name, submodules).sync()
+        return submodules, time.monotonic() - start
+
+    requests, connections = github.requests, github.connections
+    start = time.monotonic()
+    sync.group_repos_by_topic(sync.iter_repos(sync_args.token))
+    report(size, 'list_repos', 'seconds', time.monotonic() - start)
+    report(size, 'list_repos', 'requests', github.requests - requests)
+    report(size, 'list_repos', 'connections', github.connections - connections)
+
+    submodules, elapsed = run()
+    report(size, 'sync {} (initial)'.format(name), 'seconds', elapsed)
+    report(size, 'sync {} (initial)'.format(name), 'submodules', len(submodules))
+    report(size, 'sync {} (initial)'.format(name), 'submodules/s', len(submodules) / elapsed)
+
+    _, elapsed = run()
+    report(size, 'sync {} (full, init)'.format(name), 'seconds', elapsed)
+
+    pushed = random.Random(args.seed).sample(sorted(submodules), min(args.events, len(submodules)))
+    for submodule in pushed:
+        push_commit(github.remotes_dir, submodule)
+    _, elapsed = run()
+    report(size, 'sync {} (full)'.format(name), 'seconds', elapsed)
+
+    shas = dict(map(lambda submodule: (submodule, push_commit(github.remotes_dir, submodule)[1]), pushed))
+    start = time.monotonic()
+    sync.metarepo_syncer(sync_args, name, submodules).sync(shas=shas)
+    report(size, 'sync {} (pushes)'.format(name), 'seconds', time.monotonic() - start)
+
+    for submodule in pushed:
+        push_commit(github.remotes_dir, submodule)
+    sync_args.repo, sync_args.dry_run = name, True
+    start = time.monotonic()
+    plans = sync.sync_metarepos(sync_args)
+    report(size, 'plan {}'.format(name), 'seconds', time.monotonic() - start)
+    report(size, 'plan {}'.format(name), 'updated', len(plans[name]['updated']))
+    sync_args.dry_run = False
+    start = time.monotonic()
+    sync.sync_metarepos(sync_args)
+    report(size, 'sync {} (master heads)'.format(name), 'seconds', time.monotonic() - start)
+
+
+def bench_recovery(args, root, github, size):
+    # Breaks the meta repo clone, then one submodule remote, and times the sync that recovers. The
+    # submodule histories are grown between runs to show whether recovering refetches them.
+    name = args.metarepo
+    repos_by_topic = sync.group_repos_by_topic(sync.iter_repos('benchmark'))
+    submodules = sorted(sync.repos_for_topics(repos_by_topic, collections.ChainMap(*sync.METAREPOS)[name]))
+    pushed = submodules[:2]
+    commits = 1
+    for history in sorted(map(int, args.history.split(','))):
+        if history > commits:
+            start = time.monotonic()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+                list(pool.map(lambda submodule: grow_history(github.remotes_dir, submodule, history - commits, args.blob_size, args.seed), submodules))
+            logging.info('Grew %d submodule histories to %d commits in %.1fs', len(submodules), history, time.monotonic() - start)
+            commits = history
+        path = 'recover {} ({} commits)'.format(name, commits)
+        report(size, path, 'history MB', len(submodules) * (commits - 1) * args.blob_size / 1e6)
+
+        clone_dir = os.path.join(root, 'recovery-{}'.format(commits))
+        os.makedirs(clone_dir)
+        sync_args = sync.parse_args(['sync', '--dir', clone_dir, '--token', 'benchmark'] + (['--bare'] if args.bare else []))
+        syncer = sync.metarepo_syncer(sync_args, name, set(submodules))
+        start = time.monotonic()
+        syncer.sync()
+        report(size, path, 'initial seconds', time.monotonic() - start)
+
+        push_commit(github.remotes_dir, pushed[0])
+        git_dir = syncer.dir if args.bare else os.path.join(syncer.dir, '.git')
+        with open(os.path.join(git_dir, 'HEAD'), 'w') as head_file:
+            head_file.write('broken\n')
+        start = time.monotonic()
+        head = syncer.sync(shas={pushed[0]: None})
+        report(size, path, 'broken clone seconds', time.monotonic() - start)
+        report(size, path, 'broken clone recovered', int(bool(head)))
+
+        broken_remote = os.path.join(github.remotes_dir, '{}.git'.format(pushed[1]))
+        os.rename(broken_remote, '{}.broken'.format(broken_remote))
+        push_commit(github.remotes_dir, pushed[0])
+        try:
+            start = time.monotonic()
+            head = syncer.sync()
+            report(size, path, 'broken remote seconds', time.monotonic() - start)
+            report(size, path, 'broken remote recovered', int(bool(head)))
+            report(size, path, 'quarantined', len(syncer.quarantined_submodules()))
+        finally:
+            os.rename('{}.broken'.format(broken_remote), broken_remote)
+
+
+def bench_client(args, root, github, size):
+    # Lists repositories through a 502, a secondary rate limit and a GraphQL rate limit, then
+    # reconciles a topic index twice to measure ETag revalidation of the REST pages.
+    token = 'benchmark'
+    for faults in (['502'], ['403'], ['RATE_LIMITED']):
+        path = 'client ({})'.format(faults[0])
+        github.faults.extend(faults)
+        requests = github.requests
+        start = time.monotonic()
+        count = len(list(sync.iter_repos(token)))
+        report(size, path, 'seconds', time.monotonic() - start)
+        report(size, path, 'requests', github.requests - requests)
+        if count != len(github.repos):
+            logging.warning('Listed %d of %d repositories through %s', count, len(github.repos), faults[0])
+
+    topic_index = sync.TopicIndex(os.path.join(root, sync.TOPIC_INDEX_FILE))
+    for path in ('reconcile (initial)', 'reconcile (unchanged)'):
+        requests, not_modified = github.requests, github.not_modified
+        start = time.monotonic()
+        topic_index.reconcile(token)
+        report(size, path, 'seconds', time.monotonic() - start)
+        report(size, path, 'requests', github.requests - requests)
+        report(size, path, 'not modified', github.not_modified - not_modified)
+
+
+def wait_until_idle(server, deadline):
+    # The scheduler outlives server.shutdown(), so syncs must finish before the remotes are deleted.
+    while time.monotonic() < deadline:
+        if not any(map(lambda state: state.dirty or state.running, server.scheduler.states.values())):
+            return
+        time.sleep(0.1)
+    logging.warning('Meta repositories were still syncing at shutdown')
+
+
+def bench_server(args, root, github, size):
+    clone_dir = os.path.join(root, 'server')
+    os.makedirs(clone_dir)
+    server_args = sync.parse_args(
+        ['startserver', '--dir', clone_dir, '--token', 'benchmark', '--port', '0', '--sync-interval', str(args.sync_interval), '--no-describe'] +
+        (['--bare'] if args.bare else []),
+    )
+    server = sync.Server(server_args, sync.queue.Queue(), ('127.0.0.1', 0), sync.RequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    name = args.metarepo
+    metarepo_remote = os.path.join(github.remotes_dir, '{}.git'.format(name))
+
+    submodules = sorted(server.topic_index.submodules(name))
+    repos = dict(map(lambda repo: (repo, github.repos[repo]), submodules))
+    start = time.monotonic()
+    server.scheduler.mark(name, shas=None, delay=0)
+    while not server.scheduler.states[name].head:
+        time.sleep(0.1)
+    report(size, 'startserver', 'initial sync seconds', time.monotonic() - start)
+
+    def deliver(repo):
+        before, sha = push_commit(github.remotes_dir, repo)
+        payload = {
+            'ref': 'refs/heads/master',
+            'before': before,
+            'after': sha,
+            'deleted': False,
+            'repository': {'name': repo, 'default_branch': 'master', 'topics': repos[repo]},
+        }
+        request = urllib.request.Request(url, data=json.dumps(payload).encode('utf-8'), headers={
+            'Content-Type': 'application/json',
+            'X-GitHub-Event': 'push',
+            'X-GitHub-Delivery': str(uuid.uuid4()),
+        })
+        sent = time.monotonic()
+        urllib.request.urlopen(request).read()
+        return repo, sha, sent, time.monotonic() - sent
+
+    rng = random.Random(args.seed)
+    pushed = list(map(lambda _: rng.choice(submodules), range(args.events)))
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        deliveries = list(pool.map(deliver, pushed))
+    elapsed = time.monotonic() - start
+    report(size, 'startserver', 'webhooks/s', len(deliveries) / elapsed)
+    report(size, 'startserver', 'ack p50 ms', 1000 * percentile(list(map(lambda delivery: delivery[3], deliveries)), 0.5))
+    report(size, 'startserver', 'ack p95 ms', 1000 * percentile(list(map(lambda delivery: delivery[3], deliveries)), 0.95))
+
+    # Deliveries of the same repo race each other, so latency is measured from the last one sent
+    # until the gitlink reaches the repo's current head.
+    latest = {}
+    for delivery in sorted(deliveries, key=lambda delivery: delivery[2]):
+        latest[delivery[0]] = delivery
+    heads = dict(map(lambda repo: (repo, github.head(repo)), latest))
+    latencies = {}
+    deadline = time.monotonic() + args.timeout
+    while len(latencies) < len(latest) and time.monotonic() < deadline:
+        gitlinks = {}
+        for line in git('ls-tree', 'master', cwd=metarepo_remote).splitlines():
+            _, _, sha, path = line.split()
+            gitlinks[path] = sha
+        for repo, _, sent, _ in latest.values():
+            if repo not in latencies and gitlinks.get(repo) == heads[repo]:
+                latencies[repo] = time.monotonic() - sent
+        time.sleep(0.05)
+    if len(latencies) < len(latest):
+        logging.warning('%d pushes did not reach %s within %ds', len(latest) - len(latencies), name, args.timeout)
+    report(size, 'startserver', 'webhook->push p50 s', percentile(list(latencies.values()), 0.5))
+    report(size, 'startserver', 'webhook->push p95 s', percentile(list(latencies.values()), 0.95))
+    wait_until_idle(server, deadline)
+    server.shutdown()
+    server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sync.py against a fake GitHub and local bare remotes.')
+    parser.add_argument('--sizes', '-s', help='comma separated repository counts (default: {})'.format(DEFAULT_SIZES), default=DEFAULT_SIZES)
+    parser.add_argument(
+        '--distribution',
+        help='comma separated topic:weight pairs used to assign topics (default: {})'.format(DEFAULT_DISTRIBUTION),
+        default=DEFAULT_DISTRIBUTION,
+    )
+    parser.add_argument('--metarepo', '-m', help='meta repo to benchmark (default: apertium-trunk)', default='apertium-trunk')
+    parser.add_argument(
+        '--paths',
+        help='comma separated paths to benchmark, out of sync, startserver, recovery and client (default: sync,startserver)',
+        default='sync,startserver',
+    )
+    parser.add_argument('--events', '-e', type=int, help='pushes to replay (default: {})'.format(DEFAULT_EVENTS), default=DEFAULT_EVENTS)
+    parser.add_argument(
+        '--concurrency',
+        '-c',
+        type=int,
+        help='concurrent webhook deliveries (default: {})'.format(DEFAULT_CONCURRENCY),
+        default=DEFAULT_CONCURRENCY,
+    )
+    parser.add_argument(
+        '--history',
+        help='comma separated submodule history lengths in commits for the recovery path (default: {})'.format(DEFAULT_HISTORIES),
+        default=DEFAULT_HISTORIES,
+    )
+    parser.add_argument(
+        '--blob-size',
+        type=int,
+        help='bytes of random content in each submodule history commit (default: {})'.format(DEFAULT_BLOB_SIZE),
+        default=DEFAULT_BLOB_SIZE,
+    )
+    parser.add_argument('--sync-interval', '-i', type=float, help='server sync interval (default: 1s)', default=1)
+    parser.add_argument('--timeout', type=int, help='seconds to wait for replayed pushes to sync (default: 600)', default=600)
+    parser.add_argument('--bare', '-b', action='store_true', help='benchmark bare meta repo clones')
+    parser.add_argument('--seed', type=int, help='random seed (default: 0)', default=0)
+    parser.add_argument('--keep', action='store_true', help='keep the generated repositories')
+    parser.add_argument('--verbose', '-v', action='count', help='add verbosity (maximum -vv)', default=0)
+    args = parser.parse_args()
+
+    # Importing sync.py installs handlers that exit with status 0, so restore the defaults to report an
+    # interrupted run as such.
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    levels = [logging.WARNING, logging.INFO, logging.DEBUG]
+    logging.basicConfig(
+        format='[%(asctime)s] {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s',
+        level=levels[min(len(levels) - 1, args.verbose)],
+    )
+
+    distribution = list(map(lambda pair: (pair.split(':')[0], float(pair.split(':')[1])), args.distribution.split(',')))
+    paths = args.paths.split(',')
+    print('{:>6}  {:<44}  {:<24}  {:>10}'.format('repos', 'path', 'metric', 'value'))
+    for size in map(int, args.sizes.split(',')):
+        root = tempfile.mkdtemp(prefix='apertium-sync-benchmark-')
+        try:
+            remotes_dir = os.path.join(root, 'remotes')
+            os.makedirs(remotes_dir)
+            configure_git(root, remotes_dir)
+            repos = generate_repos(size, distribution, args.seed)
+            start = time.monotonic()
+            create_remotes(remotes_dir, repos.keys())
+            logging.info('Created %d remotes in %.1fs', len(repos), time.monotonic() - start)
+
+            github = FakeGitHub(remotes_dir, repos)
+            github_server = FakeGitHubServer(github)
+            threading.Thread(target=github_server.serve_forever, daemon=True).start()
+            sync.GITHUB_API = 'http://127.0.0.1:{}'.format(github_server.server_address[1])
+
+            if 'sync' in paths:
+                bench_sync(args, root, github, size)
+            if 'startserver' in paths:
+                bench_server(args, root, github, size)
+            if 'recovery' in paths:
+                bench_recovery(args, root, github, size)
+            if 'client' in paths:
+                bench_client(args, root, github, size)
+            github_server.shutdown()
+        finally:
+            if args.keep:
+                print('Kept benchmark repositories in {}'.format(root))
+            else:
+                shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
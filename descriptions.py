@@ -0,0 +1,119 @@
+'''
+    Describes Apertium language modules and pairs from their repository names.
+    Shared by add-descriptions.py and the sync server.
+'''
+
+__author__ = 'Sushain K. Cherivirala'
+__version__ = '0.1.0'
+__license__ = 'GPLv3+'
+
+import json
+import logging
+import os
+import re
+import urllib.error
+import urllib.request
+
+from github_client import GitHubError
+
+ISO_639_CODES = {'abk': 'ab', 'aar': 'aa', 'afr': 'af', 'aka': 'ak', 'sqi': 'sq', 'amh': 'am', 'ara': 'ar', 'arg': 'an', 'hye': 'hy', 'asm': 'as', 'ava': 'av', 'ave': 'ae', 'aym': 'ay', 'aze': 'az', 'bam': 'bm', 'bak': 'ba', 'eus': 'eu', 'bel': 'be', 'ben': 'bn', 'bih': 'bh', 'bis': 'bi', 'bos': 'bs', 'bre': 'br', 'bul': 'bg', 'mya': 'my', 'cat': 'ca', 'cha': 'ch', 'che': 'ce', 'nya': 'ny', 'zho': 'zh', 'chv': 'cv', 'cor': 'kw', 'cos': 'co', 'cre': 'cr', 'hrv': 'hr', 'ces': 'cs', 'dan': 'da', 'div': 'dv', 'nld': 'nl', 'dzo': 'dz', 'eng': 'en', 'epo': 'eo', 'est': 'et', 'ewe': 'ee', 'fao': 'fo', 'fij': 'fj', 'fin': 'fi', 'fra': 'fr', 'ful': 'ff', 'glg': 'gl', 'kat': 'ka', 'deu': 'de', 'ell': 'el', 'grn': 'gn', 'guj': 'gu', 'hat': 'ht', 'hau': 'ha', 'heb': 'he', 'her': 'hz', 'hin': 'hi', 'hmo': 'ho', 'hun': 'hu', 'ina': 'ia', 'ind': 'id', 'ile': 'ie', 'gle': 'ga', 'ibo': 'ig', 'ipk': 'ik', 'ido': 'io', 'isl': 'is', 'ita': 'it', 'iku': 'iu', 'jpn': 'ja', 'jav': 'jv', 'kal': 'kl', 'kan': 'kn', 'kau': 'kr', 'kas': 'ks', 'kaz': 'kk', 'khm': 'km', 'kik': 'ki', 'kin': 'rw', 'kir': 'ky', 'kom': 'kv', 'kon': 'kg', 'kor': 'ko', 'kur': 'ku', 'kua': 'kj', 'lat': 'la', 'ltz': 'lb', 'lug': 'lg', 'lim': 'li', 'lin': 'ln', 'lao': 'lo', 'lit': 'lt', 'lub': 'lu', 'lav': 'lv', 'glv': 'gv', 'mkd': 'mk', 'mlg': 'mg', 'msa': 'ms', 'mal': 'ml', 'mlt': 'mt', 'mri': 'mi', 'mar': 'mr', 'mah': 'mh', 'mon': 'mn', 'nau': 'na', 'nav': 'nv', 'nob': 'nb', 'nde': 'nd', 'nep': 'ne', 'ndo': 'ng', 'nno': 'nn', 'nor': 'no', 'iii': 'ii', 'nbl': 'nr', 'oci': 'oc', 'oji': 'oj', 'chu': 'cu', 'orm': 'om', 'ori': 'or', 'oss': 'os', 'pan': 'pa', 'pli': 'pi', 'fas': 'fa', 'pol': 'pl', 'pus': 'ps', 'por': 'pt', 'que': 'qu', 'roh': 'rm', 'run': 'rn', 'ron': 'ro', 'rus': 'ru', 'san': 'sa', 'srd': 'sc', 'snd': 'sd', 'sme': 'se', 'smo': 'sm', 'sag': 'sg', 'srp': 'sr', 'gla': 'gd', 'sna': 'sn', 'sin': 'si', 'slk': 'sk', 'slv': 'sl', 'som': 'so', 'sot': 'st', 'azb': 'az', 'spa': 'es', 'sun': 'su', 'swa': 'sw', 'ssw': 'ss', 'swe': 'sv', 'tam': 'ta', 'tel': 'te', 'tgk': 'tg', 'tha': 'th', 'tir': 'ti', 'bod': 'bo', 'tuk': 'tk', 'tgl': 'tl', 'tsn': 'tn', 'ton': 'to', 'tur': 'tr', 'tso': 'ts', 'tat': 'tt', 'twi': 'tw', 'tah': 'ty', 'uig': 'ug', 'ukr': 'uk', 'urd': 'ur', 'uzb': 'uz', 'ven': 've', 'vie': 'vi', 'vol': 'vo', 'wln': 'wa', 'cym': 'cy', 'wol': 'wo', 'fry': 'fy', 'xho': 'xh', 'yid': 'yi', 'yor': 'yo', 'zha': 'za', 'zul': 'zu',  'hbs': 'sh',  'pes': 'fa'}  # noqa: E501
+DEFAULT_APY_URL = 'https://beta.apertium.org/apy'
+DEFAULT_LANGUAGE_NAMES_CACHE = os.path.join(os.path.dirname(os.path.realpath(__file__)), '.language-names.json')
+MUTATION_BATCH_SIZE = 50
+APY_TIMEOUT = 30  # seconds
+MODULE_REPO_RE = re.compile(r'^apertium-(\w{2,3}(_\w+)?)$')
+PAIR_REPO_RE = re.compile(r'^apertium-(\w{2,3}(_\w+)?)-(\w{2,3}(_\w+)?)$')
+
+
+def load_language_names(apy_url, cache_path):
+    # The table is cached on disk and revalidated with its ETag/Last-Modified, so an unchanged
+    # table costs a 304 and an unreachable, hanging or failing APy falls back to the cached copy.
+    url = '{}/listLanguageNames?locale=eng'.format(apy_url)
+    try:
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+        if cache['url'] != url:
+            cache = None
+    except FileNotFoundError:
+        cache = None
+    except (OSError, ValueError, KeyError) as error:
+        logging.warn('Ignoring invalid language name cache %s: %s', cache_path, error)
+        cache = None
+
+    headers = {}
+    if cache and cache.get('etag'):
+        headers['If-None-Match'] = cache['etag']
+    if cache and cache.get('last_modified'):
+        headers['If-Modified-Since'] = cache['last_modified']
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=APY_TIMEOUT)
+        data = response.read()
+    except urllib.error.HTTPError as error:
+        if error.code == 304 and cache:
+            logging.info('Language names cached in %s are up to date', cache_path)
+            return cache['names']
+        if cache:
+            logging.warn('Unable to fetch language names, using the copy cached in %s: %s', cache_path, error)
+            return cache['names']
+        raise
+    except OSError as error:
+        if cache:
+            logging.warn('Unable to fetch language names, using the copy cached in %s: %s', cache_path, error)
+            return cache['names']
+        raise
+
+    names = json.loads(data.decode('utf-8'))
+    cache = {'url': url, 'etag': response.headers['ETag'], 'last_modified': response.headers['Last-Modified'], 'names': names}
+    temp_path = '{}.tmp'.format(cache_path)
+    with open(temp_path, 'w') as cache_file:
+        json.dump(cache, cache_file)
+    os.replace(temp_path, cache_path)
+    logging.info('Fetched %d language names', len(names))
+    return names
+
+
+def description_for(repo_name, topics, lang_names):
+    if {'apertium-tools', 'apertium-core'} & set(topics):
+        return None
+    module_code = MODULE_REPO_RE.match(repo_name)
+    pair_codes = PAIR_REPO_RE.match(repo_name)
+    if module_code:
+        code = module_code.group(1)
+        name = lang_names.get(ISO_639_CODES.get(code, code))
+        if name:
+            return 'Apertium linguistic data for {}'.format(name)
+        logging.warn('Unable to describe language module %s, have %s=%s', repo_name, code, repr(name))
+    elif pair_codes:
+        code1, _, code2, _ = pair_codes.groups()
+        name1, name2 = lang_names.get(ISO_639_CODES.get(code1, code1)), lang_names.get(ISO_639_CODES.get(code2, code2))
+        if name1 and name2:
+            return 'Apertium translation pair for {} and {}'.format(name1, name2)
+        logging.warn('Unable to describe pair %s, have %s=%s and %s=%s', repo_name, code1, repr(name1), code2, repr(name2))
+    return None
+
+
+def describe(client, repos):
+    # Repos are (id, name, description) and each batch is a single request of aliased mutations.
+    for start in range(0, len(repos), MUTATION_BATCH_SIZE):
+        batch = repos[start:start + MUTATION_BATCH_SIZE]
+        query = 'mutation({}) {{\n{}}}'.format(
+            ', '.join(map(lambda i: '$id{0}: ID!, $description{0}: String!'.format(i), range(len(batch)))),
+            ''.join(map(
+                lambda i: '  repo{0}: updateRepository(input: {{repositoryId: $id{0}, description: $description{0}}}) {{ clientMutationId }}\n'.format(i),
+                range(len(batch)),
+            )),
+        )
+        variables = {}
+        for i, (repo_id, _, description) in enumerate(batch):
+            variables['id{}'.format(i)], variables['description{}'.format(i)] = repo_id, description
+        try:
+            response = client.graphql(query, variables)
+        except GitHubError as error:
+            logging.error('Describing %s failed: %s', ', '.join(map(lambda repo: repo[1], batch)), error, exc_info=True)
+            continue
+        errors = response.get('errors', [])
+        for error in errors:
+            path = error.get('path') or ['']
+            index = int(path[0][len('repo'):]) if path[0].startswith('repo') else None
+            logging.error('Describing %s failed: %s', batch[index][1] if index is not None else 'repositories', error.get('message'))
+        logging.info('Described %d of %d repositories', len(batch) - len(errors), len(batch))
@@ -0,0 +1,193 @@
+'''
+    Pooled GitHub API client shared by sync.py and add-descriptions.py.
+    Keeps one keep-alive connection per thread, retries transient failures, paces requests by the
+    remaining rate limit budget and revalidates cached REST responses with their ETag.
+'''
+
+__author__ = 'Sushain K. Cherivirala'
+__version__ = '0.1.0'
+__license__ = 'GPLv3+'
+
+import collections
+import http.client
+import json
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+DEFAULT_API_URL = 'https://api.github.com'
+USER_AGENT = 'apertium-on-github'
+REQUEST_TIMEOUT = 60  # seconds
+MAX_RETRIES = 5
+MAX_BACKOFF = 60  # seconds
+LOW_BUDGET_FRACTION = 0.1
+MAX_CACHED_RESPONSES = 1000
+
+
+class GitHubError(Exception):
+    def __init__(self, status, message):
+        super().__init__('GitHub API returned {}: {}'.format(status, message))
+        self.status = status
+        self.message = message
+
+
+class RateLimit:
+    def __init__(self, limit, remaining, reset):
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset
+
+    def delay(self, now):
+        # Requests are spread over the time left until the reset once the budget runs low.
+        if now >= self.reset:
+            return 0
+        if self.remaining <= 0:
+            return self.reset - now
+        if self.remaining < self.limit * LOW_BUDGET_FRACTION:
+            return (self.reset - now) / self.remaining
+        return 0
+
+
+class GitHubClient:
+    def __init__(self, token, base_url=DEFAULT_API_URL, max_retries=MAX_RETRIES):
+        self.token = token
+        url = urllib.parse.urlsplit(base_url)
+        self.connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.host = url.netloc
+        self.path_prefix = url.path.rstrip('/')
+        self.max_retries = max_retries
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.rate_limits = {}
+        self.responses = collections.OrderedDict()
+
+    def graphql(self, query, variables=None):
+        # GraphQL errors are returned along with the data as the callers can act on partial results,
+        # except rate limiting which is waited out like its REST counterpart.
+        body = {'query': query}
+        if variables is not None:
+            body['variables'] = variables
+        for attempt in range(self.max_retries + 1):
+            _, _, data = self.request('POST', '/graphql', body, resource='graphql')
+            response = json.loads(data.decode('utf-8'))
+            if not any(map(lambda error: error.get('type') == 'RATE_LIMITED', response.get('errors') or [])):
+                return response
+            self.wait(self.rate_limit_delay('graphql', attempt), 'GraphQL rate limit exceeded')
+        raise GitHubError(200, 'GraphQL rate limit exceeded after {} attempts'.format(self.max_retries + 1))
+
+    def get(self, path):
+        # Unchanged responses come back as a 304 which does not count against the rate limit.
+        with self.lock:
+            cached = self.responses.get(path)
+        headers = {'If-None-Match': cached[0]} if cached else {}
+        status, response_headers, data = self.request('GET', path, headers=headers)
+        if status == 304 and cached:
+            logging.debug('Using cached response for %s', path)
+            return json.loads(cached[1].decode('utf-8'))
+        if response_headers.get('ETag'):
+            with self.lock:
+                self.responses[path] = (response_headers['ETag'], data)
+                self.responses.move_to_end(path)
+                while len(self.responses) > MAX_CACHED_RESPONSES:
+                    self.responses.popitem(last=False)
+        return json.loads(data.decode('utf-8'))
+
+    def request(self, method, path, body=None, headers=None, resource='core'):
+        request_headers = {
+            'Authorization': 'bearer {}'.format(self.token),
+            'User-Agent': USER_AGENT,
+            'Accept': 'application/vnd.github+json',
+        }
+        request_headers.update(headers or {})
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            request_headers['Content-Type'] = 'application/json'
+
+        for attempt in range(self.max_retries + 1):
+            self.wait(self.budget_delay(resource), 'GitHub {} rate limit budget is low'.format(resource))
+            try:
+                connection = self.connection()
+                connection.request(method, self.path_prefix + path, body=data, headers=request_headers)
+                response = connection.getresponse()
+                response_data = response.read()
+            except (http.client.HTTPException, OSError) as error:
+                # A keep-alive connection closed by GitHub fails on reuse, so reconnect right away once.
+                self.close()
+                if attempt == self.max_retries:
+                    raise
+                delay = 0 if attempt == 0 and isinstance(error, (http.client.RemoteDisconnected, BrokenPipeError)) else self.backoff(attempt)
+                self.wait(delay, 'Request to GitHub failed ({})'.format(error))
+                continue
+
+            resource = self.update_rate_limit(response.headers, resource)
+            if response.status in {403, 429} and (response.headers.get('Retry-After') or response.headers.get('X-RateLimit-Remaining') == '0'):
+                if attempt < self.max_retries:
+                    self.wait(self.rate_limit_delay(resource, attempt, response.headers.get('Retry-After')), 'GitHub rate limit exceeded')
+                    continue
+            elif response.status >= 500 and attempt < self.max_retries:
+                self.wait(self.backoff(attempt), 'GitHub returned {}'.format(response.status))
+                continue
+            if response.status >= 400:
+                raise GitHubError(response.status, response_data.decode('utf-8', 'replace'))
+            return response.status, response.headers, response_data
+
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = self.connection_class(self.host, timeout=REQUEST_TIMEOUT)
+        return self.local.connection
+
+    def close(self):
+        if getattr(self.local, 'connection', None) is not None:
+            self.local.connection.close()
+            self.local.connection = None
+
+    def update_rate_limit(self, headers, resource):
+        resource = headers.get('X-RateLimit-Resource', resource)
+        try:
+            rate_limit = RateLimit(int(headers['X-RateLimit-Limit']), int(headers['X-RateLimit-Remaining']), int(headers['X-RateLimit-Reset']))
+        except (KeyError, TypeError, ValueError):
+            return resource
+        with self.lock:
+            self.rate_limits[resource] = rate_limit
+        logging.debug('GitHub %s rate limit: %d of %d remaining', resource, rate_limit.remaining, rate_limit.limit)
+        return resource
+
+    def budget_delay(self, resource):
+        with self.lock:
+            rate_limit = self.rate_limits.get(resource)
+        return rate_limit.delay(time.time()) if rate_limit else 0
+
+    def rate_limit_delay(self, resource, attempt, retry_after=None):
+        # Secondary rate limits say how long to wait, primary ones when the budget is reset.
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        with self.lock:
+            rate_limit = self.rate_limits.get(resource)
+        if rate_limit and rate_limit.reset > time.time():
+            return rate_limit.reset - time.time() + 1
+        return self.backoff(attempt)
+
+    def backoff(self, attempt):
+        return min(MAX_BACKOFF, 2 ** attempt) * random.uniform(0.5, 1)
+
+    def wait(self, delay, reason):
+        if delay > 0:
+            logging.warn('%s, waiting %.1fs', reason, delay)
+            time.sleep(delay)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def shared_client(token, base_url=DEFAULT_API_URL):
+    with _clients_lock:
+        if (token, base_url) not in _clients:
+            _clients[(token, base_url)] = GitHubClient(token, base_url)
+        return _clients[(token, base_url)]
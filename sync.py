@@ -14,31 +14,46 @@ import atexit
 import collections
 import concurrent.futures
 import contextlib
+import fcntl
 import functools
+import gzip
+import hashlib
 import http.server
+import itertools
 import json
 import logging
 import operator
 import os
 import pprint
 import queue
+import re
 import shlex
 import shutil
 import signal
 import socket
 import socketserver
+import sqlite3
 import subprocess
 import sys
 import textwrap
 import threading
-import urllib.request
+import time
+import uuid
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from descriptions import DEFAULT_APY_URL, DEFAULT_LANGUAGE_NAMES_CACHE, describe, description_for, load_language_names
+from github_client import DEFAULT_API_URL, shared_client
 
 # Each element of this list is a dict from meta repo name to its topics.
 # Each meta repo will sync as submodules any repo with at least one of its topics.
-# The meta repos within a dict are synced in parallel but each dict is synced in serial.
+# A meta repo is only synced once no meta repo in an earlier dict has a sync due or running.
 # Therefore, meta repo B dependent on meta repo A should come in a dict after one with A.
-# Each meta repo will be synced on any Push/Repository event unless the event is associated
-# directly with any repo in its dict or a dict after it.
+# Each meta repo will only be synced on Push/Repository events for repos it contains, or contained
+# before the event, and after a meta repo it contains was synced.
 METAREPOS = [
     {
         'apertium-incubator': {'apertium-incubator'},
@@ -53,13 +68,32 @@ METAREPOS = [
     },
 ]
 ORGANIZATION = 'apertium'
-GITHUB_API = 'https://api.github.com/graphql'
+GITHUB_API = os.environ.get('GITHUB_API_URL', DEFAULT_API_URL)
+
+REST_PAGE_SIZE = 100
 
 DEFAULT_PORT = 9712
 DEFAULT_OAUTH_TOKEN = os.environ.get('GITHUB_OAUTH_TOKEN')
 DEFAULT_CLONE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'repos')
 DEFAULT_AUTHOR = 'Apertium Bot <apertiumbot@projectjj.com>'
 DEFAULT_SYNC_INTERVAL = 3  # seconds
+DEFAULT_RECONCILE_INTERVAL = 60 * 60  # seconds
+DEFAULT_LEASE_DURATION = 5 * 60  # seconds
+DEFAULT_QUARANTINE_TTL = 60 * 60  # seconds
+PROBE_TIMEOUT = 30  # seconds
+GIT_TIMEOUT = 10 * 60  # seconds
+CHECKOUT_TIMEOUT = 60 * 60  # seconds
+WORK_QUEUE_POLL_INTERVAL = 1  # seconds
+MIN_RETRY_DELAY = 10  # seconds
+MAX_RETRY_DELAY = 10 * 60  # seconds
+MASTER_HEAD_NODES = ['master: ref(qualifiedName: "refs/heads/master") { target { oid } }']
+SUBMODULE_CACHE_DIR = 'submodules.git'
+QUARANTINE_FILE = 'quarantine.json'
+TOPIC_INDEX_FILE = 'topic-index.json'
+EVENT_JOURNAL_FILE = 'events.journal'
+WORK_QUEUE_FILE = 'work-queue.db'
+SNAPSHOT_FILE = 'snapshot.json.gz'
+SNAPSHOT_MAX_AGE = 60  # seconds
 
 server = None
 
@@ -78,6 +112,7 @@ atexit.register(close_socket)
 
 def signal_handler(signal, frame):
     close_socket()
+    sys.exit(0)
 
 
 signal.signal(signal.SIGINT, signal_handler)
@@ -85,12 +120,76 @@ signal.signal(signal.SIGQUIT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
 
 
-def _list_repos(token, after=None, extra_nodes=None):
-    headers = {
-        'Authorization': 'bearer {}'.format(token),
-    }
-    request_data = json.dumps({
-        'query': textwrap.dedent('''
+class Metrics:
+    # Minimal registry rendered in the Prometheus text exposition format.
+    DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float('inf'))
+    COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, float('inf'))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = collections.OrderedDict()
+        self.gauges = collections.OrderedDict()
+
+    def histogram(self, name, help_text, buckets=DURATION_BUCKETS):
+        self.histograms[name] = (help_text, buckets, collections.OrderedDict())
+
+    def gauge(self, name, help_text, function):
+        self.gauges[name] = (help_text, function)
+
+    def observe(self, name, value, **labels):
+        _, buckets, series = self.histograms[name]
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            bucket_counts, total = series.get(key, ([0] * len(buckets), 0))
+            for i, bucket in enumerate(buckets):
+                if value <= bucket:
+                    bucket_counts[i] += 1
+            series[key] = (bucket_counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def render(self):
+        def format_labels(labels):
+            return '{{{}}}'.format(','.join(map(lambda label: '{}="{}"'.format(*label), labels))) if labels else ''
+
+        lines = []
+        with self.lock:
+            for name, (help_text, buckets, series) in self.histograms.items():
+                lines.extend(['# HELP {} {}'.format(name, help_text), '# TYPE {} histogram'.format(name)])
+                for labels, (bucket_counts, total) in series.items():
+                    for bucket, count in zip(buckets, bucket_counts):
+                        le = '+Inf' if bucket == float('inf') else repr(bucket)
+                        lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', le),)), count))
+                    lines.append('{}_sum{} {}'.format(name, format_labels(labels), total))
+                    lines.append('{}_count{} {}'.format(name, format_labels(labels), bucket_counts[-1]))
+        for name, (help_text, function) in self.gauges.items():
+            lines.extend(['# HELP {} {}'.format(name, help_text), '# TYPE {} gauge'.format(name), '{} {}'.format(name, function())])
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.histogram('apertium_sync_list_repos_seconds', 'Time to list all repositories of the organization.')
+metrics.histogram('apertium_sync_phase_seconds', 'Time spent in each phase of a meta repository sync.')
+metrics.histogram('apertium_sync_events_per_batch', 'Number of events coalesced into each batch.', buckets=Metrics.COUNT_BUCKETS)
+metrics.histogram('apertium_sync_webhook_to_push_seconds', 'Time from receiving the oldest event covered by a sync to its push.')
+
+
+class LazyPrettyFormat:
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return pprint.pformat(self.obj, indent=2)
+
+
+def _fetch_repos_page(token, after=None, extra_nodes=None):
+    response = shared_client(token, GITHUB_API).graphql(textwrap.dedent('''
           {
             organization(login: "%s") {
               repositories(first: 100%s) {
@@ -117,118 +216,530 @@ def _list_repos(token, after=None, extra_nodes=None):
             ORGANIZATION,
             (', after: "{}"'.format(after) if after else ''),
             '\n'.join(extra_nodes) if extra_nodes else ''
-        )
-    }).encode("utf-8")
-    request = urllib.request.Request(GITHUB_API, data=request_data, headers=headers)
-    response = urllib.request.urlopen(request).read().decode('utf-8')
-    data = json.loads(response)['data']
-    repos = data['organization']['repositories']
-    if repos['pageInfo']['hasNextPage']:
-        logging.debug('Fetched list of %d repositories, continuing to next page', len(repos['edges']))
-        return repos['edges'] + _list_repos(token, after=repos['pageInfo']['endCursor'], extra_nodes=extra_nodes)
-    else:
-        logging.debug('Fetched list of %d repositories, query complete', len(repos['edges']))
-        return repos['edges']
-
-
-def list_repos(token, **kwargs):
+        ))
+    return response['data']['organization']['repositories']
+
+
+def iter_repos(token, extra_nodes=None):
+    logging.info('Listing repositories')
+    start = time.monotonic()
+    after = None
+    count = 0
+    while True:
+        repos = _fetch_repos_page(token, after=after, extra_nodes=extra_nodes)
+        count += len(repos['edges'])
+        logging.debug('Fetched page of %d repositories', len(repos['edges']))
+        for edge in repos['edges']:
+            yield edge['node']
+        if not repos['pageInfo']['hasNextPage']:
+            break
+        after = repos['pageInfo']['endCursor']
+    metrics.observe('apertium_sync_list_repos_seconds', time.monotonic() - start)
+    logging.info('Fetched list of %d repositories', count)
+
+
+def iter_repos_rest(token):
+    # Unlike iter_repos, pages are revalidated with their ETag so listing an unchanged
+    # organization costs no rate limit. Sorting by name keeps the pages stable.
     logging.info('Listing repositories')
-    repos = _list_repos(token, after=None, **kwargs)
-    logging.info('Fetched list of %d repositories', len(repos))
-    logging.debug('Feched repositories:\n%s', pprint.pformat(repos, indent=2))
-    return repos
+    client = shared_client(token, GITHUB_API)
+    start = time.monotonic()
+    page = 1
+    count = 0
+    while True:
+        repos = client.get('/orgs/{}/repos?type=all&sort=full_name&per_page={}&page={}'.format(ORGANIZATION, REST_PAGE_SIZE, page))
+        count += len(repos)
+        logging.debug('Fetched REST page %d of %d repositories', page, len(repos))
+        yield from repos
+        if len(repos) < REST_PAGE_SIZE:
+            break
+        page += 1
+    metrics.observe('apertium_sync_list_repos_seconds', time.monotonic() - start)
+    logging.info('Fetched list of %d repositories', count)
+
+
+def repo_visibility(repo):
+    # Payloads and listings from GitHub Enterprise Server predating `visibility` only say `private`.
+    return repo.get('visibility') or ('private' if repo.get('private', True) else 'public')
 
 
 def group_repos_by_topic(repos):
     groups = collections.defaultdict(list)
     for repo in repos:
-        name = repo['node']['name']
-        for topicNode in repo['node']['repositoryTopics']['nodes']:
-            groups[topicNode['topic']['name']].append(name)
-    logging.debug('Grouped repositories:\n%s', pprint.pformat(groups, indent=2))
+        for topicNode in repo['repositoryTopics']['nodes']:
+            groups[topicNode['topic']['name']].append(repo['name'])
+    logging.debug('Grouped repositories:\n%s', LazyPrettyFormat(groups))
     return groups
 
 
+def master_heads(repos):
+    # Like `git submodule update --remote` with `branch = master`, gitlinks follow the master branch.
+    # Empty repositories and ones without a master branch have nothing to record as a gitlink.
+    return dict(map(
+        lambda repo: (repo['name'], repo['master']['target']['oid']),
+        filter(lambda repo: repo.get('master'), repos),
+    ))
+
+
+def remote_url(name):
+    return 'git@github.com:{}/{}.git'.format(ORGANIZATION, name)
+
+
+def format_gitmodules(gitmodules):
+    return ''.join(map(
+        lambda item: '[submodule "{}"]\n'.format(item[0]) + ''.join(map(lambda option: '\t{} = {}\n'.format(*option), item[1].items())),
+        gitmodules.items(),
+    ))
+
+
 def repos_for_topics(repos_by_topic, topics):
-    return functools.reduce(operator.or_, map(lambda topic: set(repos_by_topic[topic]), topics))
+    return set(itertools.chain.from_iterable(map(lambda topic: repos_by_topic.get(topic, ()), topics)))
+
+
+def index_metarepos_by_topic():
+    metarepos_by_topic = collections.defaultdict(set)
+    for metarepo_group in METAREPOS:
+        for name, topics in metarepo_group.items():
+            for topic in topics:
+                metarepos_by_topic[topic].add(name)
+    return metarepos_by_topic
+
+
+class TopicIndex:
+    # Besides the topics of each repo, the index keeps which meta repos contain each repo and the
+    # reverse so that routing an event or listing the submodules of a meta repo is a lookup.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.metarepos_by_topic = index_metarepos_by_topic()
+        self.repos = {}
+        self.descriptions = {}
+        self.visibilities = {}
+        self.metarepos = {}
+        self.members = collections.defaultdict(set)
+
+    def load(self):
+        try:
+            with open(self.path) as index_file:
+                index = json.load(index_file)
+                repos, descriptions, visibilities = index['repos'], index.get('descriptions', {}), index['visibilities']
+        except FileNotFoundError:
+            logging.info('No topic index found at %s', self.path)
+            return False
+        except (OSError, ValueError, KeyError) as error:
+            logging.warn('Unable to load topic index from %s: %s', self.path, error)
+            return False
+        with self.lock:
+            self.repos, self.metarepos, self.members = {}, {}, collections.defaultdict(set)
+            for name, topics in repos.items():
+                self._set(name, topics)
+            self.descriptions = descriptions
+            self.visibilities = visibilities
+        logging.info('Loaded topic index of %d repositories from %s', len(repos), self.path)
+        return True
+
+    def save(self):
+        with self.lock:
+            temp_path = '{}.tmp'.format(self.path)
+            with open(temp_path, 'w') as index_file:
+                json.dump({'repos': self.repos, 'descriptions': self.descriptions, 'visibilities': self.visibilities}, index_file, sort_keys=True)
+            os.replace(temp_path, self.path)
+
+    def reconcile(self, token):
+        # Returns the meta repos affected by each changed repository, before or after the change.
+        repos = {}
+        descriptions = {}
+        visibilities = {}
+        for repo in iter_repos_rest(token):
+            repos[repo['name']] = sorted(repo.get('topics') or [])
+            descriptions[repo['name']] = repo['description']
+            visibilities[repo['name']] = repo_visibility(repo)
+        with self.lock:
+            self.descriptions = descriptions
+            self.visibilities = visibilities
+            changed = {}
+            for name in repos.keys() | self.repos.keys():
+                if repos.get(name) != self.repos.get(name):
+                    changed[name] = self._remove(name) | (self._set(name, repos[name]) if name in repos else set())
+            self.save()
+        logging.info('Reconciled topic index, %d repositories changed: %s', len(changed), set(changed))
+        return changed
+
+    def apply_event(self, event, payload):
+        # Returns the meta repos the event concerns. Repository events only concern the meta repos a
+        # repository joined or left, or all of its old and new ones when it was renamed, so edits
+        # that keep its topics (including our own description updates) sync nothing.
+        name = payload['repository']['name']
+        if event == 'reconcile':
+            return set(payload['metarepos'])
+        if event != 'repository':
+            return self.metarepos_for(name)
+        action = payload['action']
+        topics = sorted(payload['repository'].get('topics') or [])
+        with self.lock:
+            metarepos = self._remove(name)
+            self.descriptions.pop(name, None)
+            # Payloads journaled before visibilities were recorded keep the one already indexed.
+            visibility = payload['repository'].get('visibility', self.visibilities.pop(name, None))
+            if action == 'renamed':
+                old_name = payload['changes']['repository']['name']['from']
+                metarepos |= self._remove(old_name) | self._set(name, topics)
+                self.descriptions.pop(old_name, None)
+                visibility = payload['repository'].get('visibility', self.visibilities.pop(old_name, None))
+            elif action != 'deleted':
+                metarepos ^= self._set(name, topics)
+            if action != 'deleted':
+                self.descriptions[name] = payload['repository'].get('description')
+                self.visibilities[name] = visibility
+            self.save()
+        logging.debug('Applied repository %s event for %s to topic index', action, name)
+        return metarepos
+
+    def snapshot(self):
+        # The snapshot is served to anyone, so repos that are not public are left out.
+        with self.lock:
+            return list(map(
+                lambda name: {'name': name, 'description': self.descriptions.get(name), 'topics': self.repos[name]},
+                sorted(filter(lambda name: self.visibilities.get(name) == 'public', self.repos)),
+            ))
+
+    def metarepos_for(self, name):
+        with self.lock:
+            return set(self.metarepos.get(name, ()))
+
+    def submodules(self, metarepo):
+        with self.lock:
+            return set(self.members[metarepo])
+
+    def _set(self, name, topics):
+        # A meta repo is never a submodule of itself.
+        metarepos = set(itertools.chain.from_iterable(map(lambda topic: self.metarepos_by_topic.get(topic, ()), topics))) - {name}
+        self.repos[name] = topics
+        self.metarepos[name] = metarepos
+        for metarepo in metarepos:
+            self.members[metarepo].add(name)
+        return set(metarepos)
+
+    def _remove(self, name):
+        self.repos.pop(name, None)
+        metarepos = self.metarepos.pop(name, set())
+        for metarepo in metarepos:
+            self.members[metarepo].discard(name)
+        return metarepos
+
+
+class SubmoduleCache:
+    # A single bare repo holding the full history of every submodule as refs/heads/<name>. Meta
+    # repo clones borrow its objects through alternates so each upstream commit is fetched once,
+    # however many meta repos contain it. Unreachable objects are never pruned since borrowing
+    # checkouts may still point at commits that were force-pushed away. Fetches of a submodule are
+    # serialised with a file lock as worker processes can share the cache.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def init(self):
+        with self.lock:
+            if not os.path.isdir(self.path):
+                logging.info('Creating submodule cache %s', self.path)
+                subprocess.check_call(['git', 'init', '--quiet', '--bare', self.path])
+                subprocess.check_call(shlex.split('git config gc.pruneExpire never'), cwd=self.path)
+                os.makedirs(os.path.join(self.path, 'fetch-locks'), exist_ok=True)
+
+    def objects_dir(self):
+        return os.path.join(self.path, 'objects')
+
+    def fetch(self, submodules):
+        def fetch_submodule(submodule):
+            with open(os.path.join(self.path, 'fetch-locks', submodule), 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                subprocess.check_call(
+                    ['git', 'fetch', '--quiet', '--no-tags', remote_url(submodule), '+refs/heads/master:refs/heads/{}'.format(submodule)],
+                    cwd=self.path, timeout=GIT_TIMEOUT,
+                )
+
+        self.init()
+        logging.debug('Fetching %d submodules into submodule cache', len(submodules))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(fetch_submodule, submodules))
+        return self.heads(submodules)
+
+    def heads(self, submodules):
+        for_each_ref_output = subprocess.check_output(
+            shlex.split('git for-each-ref --format="%(refname:lstrip=2) %(objectname)" refs/heads'), cwd=self.path, universal_newlines=True,
+        )
+        heads = dict(map(str.split, for_each_ref_output.splitlines()))
+        return dict(map(lambda submodule: (submodule, heads[submodule]), submodules))
+
+
+submodule_caches = {}
+submodule_caches_lock = threading.Lock()
+
+
+def submodule_cache(clone_dir):
+    with submodule_caches_lock:
+        if clone_dir not in submodule_caches:
+            submodule_caches[clone_dir] = SubmoduleCache(os.path.abspath(os.path.join(clone_dir, SUBMODULE_CACHE_DIR)))
+        return submodule_caches[clone_dir]
+
+
+class SubmoduleError(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def submodule_io():
+    # Tells failures fetching, listing or checking out submodules apart from ones of the meta repo
+    # itself, since only the former are worth probing every submodule remote for.
+    try:
+        yield
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as error:
+        raise SubmoduleError(error) from error
+
+
+def probe_remotes(submodules):
+    # Returns the submodules whose remote cannot list its master branch within PROBE_TIMEOUT.
+    def probe(submodule):
+        try:
+            subprocess.run(
+                ['git', 'ls-remote', '--exit-code', remote_url(submodule), 'refs/heads/master'],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=PROBE_TIMEOUT, check=True,
+            )
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            return False
+        return True
+
+    logging.info('Probing %d submodule remotes', len(submodules))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as pool:
+        return set(itertools.compress(submodules, map(operator.not_, pool.map(probe, submodules))))
+
+
+class SubmoduleQuarantine:
+    # Submodules whose remotes failed a probe, with the wall clock time their quarantine ends. They
+    # keep their gitlinks but are neither fetched nor added to a meta repo until it is over. The
+    # file is read on every use since worker processes can share it.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def active(self):
+        now = time.time()
+        with self.lock:
+            return set(map(operator.itemgetter(0), filter(lambda item: item[1] > now, self._load().items())))
+
+    def add(self, submodules, ttl):
+        now = time.time()
+        with self.lock:
+            expiries = dict(filter(lambda item: item[1] > now, self._load().items()))
+            expiries.update(map(lambda submodule: (submodule, now + ttl), submodules))
+            temp_path = '{}.tmp'.format(self.path)
+            with open(temp_path, 'w') as quarantine_file:
+                json.dump(expiries, quarantine_file, sort_keys=True)
+            os.replace(temp_path, self.path)
+
+    def _load(self):
+        try:
+            with open(self.path) as quarantine_file:
+                return json.load(quarantine_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as error:
+            logging.warn('Unable to load submodule quarantine from %s: %s', self.path, error)
+            return {}
+
+
+submodule_quarantines = {}
+submodule_quarantines_lock = threading.Lock()
+
+
+def submodule_quarantine(clone_dir):
+    with submodule_quarantines_lock:
+        if clone_dir not in submodule_quarantines:
+            submodule_quarantines[clone_dir] = SubmoduleQuarantine(os.path.join(clone_dir, QUARANTINE_FILE))
+        return submodule_quarantines[clone_dir]
 
 
 class MetaRepoSyncer:
-    def __init__(self, clone_dir, name, submodules, author):
+    def __init__(self, clone_dir, name, submodules, author, quarantine_ttl=DEFAULT_QUARANTINE_TTL):
         self.clone_dir = clone_dir
         self.name = name
         self.submodules = submodules
         self.author = author
+        self.quarantine_ttl = quarantine_ttl
 
         self.dir = os.path.join(clone_dir, name)
         self.check_call = functools.partial(subprocess.check_call, cwd=self.dir)
+        self.cache = submodule_cache(clone_dir)
+        self.quarantine = submodule_quarantine(clone_dir)
 
     def clone(self, init_submodules=True):
-        if not os.path.isdir(os.path.join(self.clone_dir, self.name)):
+        if not os.path.isdir(self.dir):
             logging.info('Cloning meta repository %s', self.name)
-            subprocess.check_call(shlex.split('git clone --depth 1 git@github.com:{}/{}.git'.format(ORGANIZATION, self.name)), cwd=self.clone_dir)
+            subprocess.check_call(
+                ['git', 'clone', '--depth', '1', '--filter=blob:none', remote_url(self.name), self.dir], cwd=self.clone_dir, timeout=GIT_TIMEOUT,
+            )
             if init_submodules and self._has_submodules():
-                self.check_call(shlex.split('git submodule update --depth 1 --init --jobs 8'))
+                submodules = self.healthy_submodules()
+                with submodule_io():
+                    self.cache.fetch(submodules)
+                    self.check_out_submodules(submodules, fetch=True)
         else:
             logging.debug('Meta repository %s already cloned', self.name)
 
+    def pull(self):
+        # Only this script commits to meta repos so resetting is safe and, unlike a rebase,
+        # ignores submodule working trees that lag behind their gitlinks.
+        self.check_call(shlex.split('git fetch --depth 1 origin master'), timeout=GIT_TIMEOUT)
+        # Blobs missing from the blob-less clone are fetched on demand, so local commands reading
+        # them are bounded too.
+        self.check_call(shlex.split('git reset --quiet --hard FETCH_HEAD'), timeout=GIT_TIMEOUT)
+
     def update(self):
-        self.check_call(shlex.split('git pull --rebase --autostash'))
-        self.check_call(shlex.split('git submodule update --jobs 8 --remote'))
-        changeset = subprocess.check_output(shlex.split('git diff --name-only'), cwd=self.dir, universal_newlines=True).splitlines()
-        logging.debug('Changeset is: %s', changeset)
-        submodule_changeset = list(filter(lambda change: change in self.submodules, changeset))
+        # Submodules are fetched into the shared cache and checked out from the borrowed objects.
+        self.pull()
+        submodules = self.healthy_submodules()
+        with submodule_io():
+            heads = self.cache.fetch(submodules)
+        submodule_changeset = self.set_gitlinks(heads)
+        self.borrow_objects(submodules)
+        with submodule_io():
+            self.check_out_submodules(submodules)
+        return submodule_changeset
+
+    def healthy_submodules(self):
+        return sorted((self.list_submodules_present() & self.submodules) - self.quarantine.active())
+
+    def quarantined_submodules(self):
+        return self.submodules & self.quarantine.active()
+
+    def check_out_submodules(self, submodules, fetch=False):
+        if submodules:
+            self.check_call(
+                ['git', 'submodule', 'update', '--init', '--reference', self.cache.path, '--jobs', '8'] +
+                ([] if fetch else ['--no-fetch']) + ['--'] + submodules,
+                timeout=CHECKOUT_TIMEOUT,
+            )
+
+    def borrow_objects(self, submodules):
+        # Submodules cloned before the cache existed start borrowing from it too.
+        for submodule in submodules:
+            alternates_path = os.path.join(self.dir, '.git', 'modules', submodule, 'objects', 'info', 'alternates')
+            if os.path.isdir(os.path.dirname(alternates_path)) and not os.path.exists(alternates_path):
+                with open(alternates_path, 'w') as alternates_file:
+                    alternates_file.write('{}\n'.format(self.cache.objects_dir()))
+
+    def update_gitlinks(self, shas):
+        self.pull()
+        return self.set_gitlinks(shas)
+
+    def set_gitlinks(self, shas):
+        paths = sorted(set(shas.keys()) & self.submodules)
+        gitlinks = self.list_gitlinks()
+        submodule_changeset = list(filter(lambda path: path in gitlinks and gitlinks[path] != shas[path], paths))
         logging.debug('Submodule changeset is: %s', submodule_changeset)
+        if submodule_changeset:
+            self.update_index(map(lambda path: ('160000', shas[path], path), submodule_changeset))
         logging.info('Meta repository %s has %d updated submodules', self.name, len(submodule_changeset))
         return submodule_changeset
 
+    def update_index(self, entries):
+        # Entries are (mode, sha, path) and a mode of 0 removes the path from the index.
+        index_info = ''.join(map(lambda entry: '{} {}\t{}\n'.format(*entry), entries))
+        subprocess.run(shlex.split('git update-index --index-info'), cwd=self.dir, input=index_info, universal_newlines=True, check=True)
+
+    def list_gitlinks(self):
+        ls_files_output = subprocess.check_output(shlex.split('git ls-files --stage'), cwd=self.dir, universal_newlines=True)
+        gitlinks = {}
+        for line in ls_files_output.splitlines():
+            info, path = line.split('\t', 1)
+            mode, sha, _ = info.split()
+            if mode == '160000':
+                gitlinks[path] = sha
+        return gitlinks
+
+    def head(self):
+        return subprocess.check_output(shlex.split('git rev-parse HEAD'), cwd=self.dir, universal_newlines=True).strip()
+
     def list_submodules_present(self):
+        return set(self.read_gitmodules().keys())
+
+    def read_gitmodules(self):
+        gitmodules = collections.OrderedDict()
         if self._has_submodules():
-            submodule_list_output = subprocess.check_output(
-                shlex.split('git config --file .gitmodules --name-only --get-regexp path'),
-                cwd=self.dir,
-                universal_newlines=True,
+            config_output = subprocess.check_output(
+                shlex.split('git config --blob :.gitmodules --list'), cwd=self.dir, universal_newlines=True, timeout=GIT_TIMEOUT,
             )
-            return set(map(lambda line: line.split('.')[1], submodule_list_output.splitlines()))
-        return set()
+            for line in config_output.splitlines():
+                key, value = line.split('=', 1)
+                name, option = key[len('submodule.'):].rsplit('.', 1)
+                gitmodules.setdefault(name, collections.OrderedDict())[option] = value
+        return gitmodules
+
+    def write_gitmodules(self, gitmodules):
+        content = format_gitmodules(gitmodules)
+        with open(os.path.join(self.dir, '.gitmodules'), 'w') as gitmodules_file:
+            gitmodules_file.write(content)
+        return self.hash_object(content)
 
-    def add_submodules(self, submodules_present):
-        submodules_missing = self.submodules - submodules_present
-        for submodule in submodules_missing:
-            logging.debug('Adding submodule %s to meta repository %s', submodule, self.name)
-            self.check_call(shlex.split('git submodule add --branch master git@github.com:{}/{}.git'.format(ORGANIZATION, submodule)))
-        return submodules_missing
+    def hash_object(self, content):
+        return subprocess.check_output(shlex.split('git hash-object -w --stdin'), cwd=self.dir, input=content, universal_newlines=True).strip()
 
-    def remove_submodules(self, submodules_present):
+    def update_submodules(self, submodules_present, shas=None):
+        # The whole membership delta is applied with a single .gitmodules rewrite and index update.
+        # Added submodules whose commit is not already known in shas are resolved with ls-remote,
+        # unless they are quarantined. Ones that cannot be resolved are quarantined and left out.
+        shas = dict(shas or {})
         submodules_extra = submodules_present - self.submodules
+        submodules_missing = self.submodules - submodules_present - (self.quarantine.active() - shas.keys())
+        if not submodules_extra and not submodules_missing:
+            return submodules_extra, submodules_missing
+
+        logging.debug('Removing submodules %s from meta repository %s', submodules_extra, self.name)
+        logging.debug('Adding submodules %s to meta repository %s', submodules_missing, self.name)
+        shas.update(self.resolve_or_quarantine(sorted(submodules_missing - shas.keys())))
+        submodules_missing = set(filter(lambda submodule: submodule in shas, submodules_missing))
+        gitmodules = self.read_gitmodules()
         for submodule in submodules_extra:
-            logging.debug('Removing submodule %s from meta repository %s', submodule, self.name)
-            self.check_call(shlex.split('git submodule deinit --force -- {}'.format(submodule)))
-            self.check_call(shlex.split('git rm --force {}'.format(submodule)))
-            self.check_call(shlex.split('rm -rf .git/modules/{}'.format(submodule)))
-        return submodules_extra
+            del gitmodules[submodule]
+        for submodule in sorted(submodules_missing):
+            gitmodules[submodule] = collections.OrderedDict([('path', submodule), ('url', remote_url(submodule)), ('branch', 'master')])
+        entries = [('100644', self.write_gitmodules(gitmodules), '.gitmodules')]
+        entries.extend(map(lambda submodule: ('0', '0' * 40, submodule), sorted(submodules_extra)))
+        entries.extend(map(lambda submodule: ('160000', shas[submodule], submodule), sorted(submodules_missing)))
+        self.update_index(entries)
+        self.remove_checkouts(submodules_extra)
+        return submodules_extra, submodules_missing
+
+    def remove_checkouts(self, submodules):
+        for submodule in submodules:
+            shutil.rmtree(os.path.join(self.dir, submodule), ignore_errors=True)
+            shutil.rmtree(os.path.join(self.dir, '.git', 'modules', submodule), ignore_errors=True)
 
     def commit(self, submodule_changeset, submodules_extra, submodules_missing):
-        clean = subprocess.call(shlex.split('git diff-index --quiet HEAD --'), cwd=self.dir) == 0
+        clean = subprocess.call(shlex.split('git diff-index --cached --quiet HEAD --'), cwd=self.dir) == 0
         if not clean:
             logging.info('Committing changes to meta repository %s', self.name)
-            commit_message = textwrap.dedent('''
-                Sync submodules ({0}U, {2}D, {4}A)
-                Updated: {1}.
-                Deleted: {3}.
-                Added: {5}.
-            '''.format(
-                len(submodule_changeset), ', '.join(submodule_changeset) or 'None',
-                len(submodules_extra), ', '.join(submodules_extra) or 'None',
-                len(submodules_missing), ', '.join(submodules_missing) or 'None',
-            ))
-            logging.debug('Meta repository %s commit message: %s', self.name, commit_message)
-            self.check_call(shlex.split('git commit --all --author "{}" --message "{}"'.format(self.author, commit_message)))
+            commit_message = self.commit_message(submodule_changeset, submodules_extra, submodules_missing)
+            self.check_call(shlex.split('git commit --author "{}" --message "{}"'.format(self.author, commit_message)))
         else:
             logging.info('Meta repository %s requires no changes', self.name)
 
+    def commit_message(self, submodule_changeset, submodules_extra, submodules_missing):
+        commit_message = textwrap.dedent('''
+            Sync submodules ({0}U, {2}D, {4}A)
+            Updated: {1}.
+            Deleted: {3}.
+            Added: {5}.
+        '''.format(
+            len(submodule_changeset), ', '.join(submodule_changeset) or 'None',
+            len(submodules_extra), ', '.join(submodules_extra) or 'None',
+            len(submodules_missing), ', '.join(submodules_missing) or 'None',
+        ))
+        logging.debug('Meta repository %s commit message: %s', self.name, commit_message)
+        return commit_message
+
     def push(self):
-        self.check_call(shlex.split('git push --set-upstream origin master'))
+        self.check_call(shlex.split('git push --set-upstream origin master'), timeout=GIT_TIMEOUT)
 
     def nuke(self):
         logging.debug('Nuking meta repository %s', self.name)
@@ -237,55 +748,373 @@ class MetaRepoSyncer:
     def _has_submodules(self):
         return os.path.exists(os.path.join(self.dir, '.gitmodules'))
 
-    def _sync_with_invalid_submodules(self):
-        self.nuke()
-        self.clone(init_submodules=False)
-        submodules_present = self.list_submodules_present()
-        submodules_extra = self.remove_submodules(submodules_present)
-        self.commit([], submodules_extra, [])
-        self.push()
-        self.nuke()
-        self.sync(remove_orphans=False)
+    def _is_valid_clone(self):
+        return os.path.isdir(self.dir) and subprocess.call(
+            shlex.split('git rev-parse --verify --quiet HEAD'), cwd=self.dir, stdout=subprocess.DEVNULL,
+        ) == 0
+
+    def _recover(self, shas, probe):
+        # Rather than failing every sync on one broken or slow upstream repo, all submodule remotes
+        # are probed after a submodule failure and the failing ones quarantined so that the rest of
+        # the meta repo still syncs. The clone is kept and reset to the remote so that recovering
+        # costs a fetch, unless it is broken.
+        if self._is_valid_clone():
+            self.pull()
+        else:
+            if os.path.isdir(self.dir):
+                self.nuke()
+            self.clone(init_submodules=False)
+        if probe:
+            failing = probe_remotes(sorted((self.list_submodules_present() | self.submodules) - self.quarantine.active()))
+            if failing:
+                logging.warn('Quarantining submodules of meta repository %s for %ds: %s', self.name, self.quarantine_ttl, sorted(failing))
+                self.quarantine.add(failing, self.quarantine_ttl)
+        return self.sync(recover=False, shas=shas)
+
+    def resolve_remote_heads(self, submodules, strict=True):
+        # Unless strict, submodules whose master head cannot be listed are left out of the result.
+        def ls_remote(submodule):
+            command = ['git', 'ls-remote', '--exit-code', remote_url(submodule), 'refs/heads/master']
+            if strict:
+                return subprocess.check_output(command, universal_newlines=True, timeout=PROBE_TIMEOUT).split()[0]
+            try:
+                return subprocess.check_output(command, universal_newlines=True, stderr=subprocess.DEVNULL, timeout=PROBE_TIMEOUT).split()[0]
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as error:
+                logging.warn('Unable to list the master head of %s: %s', submodule, error)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            return dict(filter(lambda item: item[1], zip(submodules, pool.map(ls_remote, submodules))))
+
+    def resolve_or_quarantine(self, submodules):
+        # An empty, unreachable or master-less repo is quarantined rather than failing the whole sync.
+        heads = self.resolve_remote_heads(submodules, strict=False)
+        failing = set(submodules) - heads.keys()
+        if failing:
+            logging.warn('Quarantining submodules of meta repository %s for %ds: %s', self.name, self.quarantine_ttl, sorted(failing))
+            self.quarantine.add(failing, self.quarantine_ttl)
+        return heads
 
-    def sync(self, remove_orphans=True):
+    def resolve_pushed_heads(self, shas):
+        # Pushed repos are recorded without a commit and resolved to their current head.
+        pushed = sorted(set(map(operator.itemgetter(0), filter(lambda item: item[1] is None, shas.items()))) & self.submodules)
+        resolved = dict(filter(lambda item: item[1] is not None, shas.items()))
+        resolved.update(self.resolve_or_quarantine(pushed))
+        return resolved
+
+    def sync(self, recover=True, shas=None):
         logging.info('Syncing meta repository %s', self.name)
 
         try:
-            self.clone()
-        except subprocess.CalledProcessError as error:
-            if remove_orphans:
-                logging.warn('Cloning meta repository %s failed, removing invalid submodules: %s', self.name, error, exc_info=True)
-                self._sync_with_invalid_submodules()
-            else:
-                logging.error('Syncing meta repository %s failed after removing invalid submodules: %s', self.name, error, exc_info=True)
+            with self.timed('clone'):
+                self.clone(init_submodules=shas is None)
+            with self.timed('update'):
+                if shas is None:
+                    submodule_changeset = self.update()
+                else:
+                    shas = self.resolve_pushed_heads(shas)
+                    submodule_changeset = self.update_gitlinks(shas)
+        except SubmoduleError as error:
+            if recover:
+                logging.warn('Updating submodules of meta repository %s failed, probing submodules: %s', self.name, error, exc_info=True)
+                return self._recover(shas, probe=True)
+            logging.error('Syncing meta repository %s failed after probing submodules: %s', self.name, error, exc_info=True)
             return
-
-        try:
-            submodule_changeset = self.update()
-        except subprocess.CalledProcessError as error:
-            if remove_orphans:
-                logging.warn('Updating meta repository %s failed, removing invalid submodules: %s', self.name, error, exc_info=True)
-                self._sync_with_invalid_submodules()
-            else:
-                logging.error('Syncing meta repository %s failed after removing invalid submodules: %s', self.name, error, exc_info=True)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as error:
+            if recover:
+                logging.warn('Updating meta repository %s failed, repairing its clone: %s', self.name, error, exc_info=True)
+                return self._recover(shas, probe=False)
+            logging.error('Syncing meta repository %s failed after repairing its clone: %s', self.name, error, exc_info=True)
             return
 
+        with self.timed('update_submodules'):
+            submodules_present = self.list_submodules_present()
+            submodules_extra, submodules_missing = self.update_submodules(submodules_present, shas=shas)
+        with self.timed('commit'):
+            self.commit(submodule_changeset, submodules_extra, submodules_missing)
+        with self.timed('push'):
+            self.push()
+        return self.head()
+
+    def plan(self, shas):
+        # Compares the meta repo tree with the desired commits without touching any submodule.
+        if os.path.isdir(self.dir):
+            self.pull()
+        else:
+            self.clone(init_submodules=False)
+        gitlinks = self.list_gitlinks()
         submodules_present = self.list_submodules_present()
-        submodules_extra = self.remove_submodules(submodules_present)
-        submodules_missing = self.add_submodules(submodules_present)
-        self.commit(submodule_changeset, submodules_extra, submodules_missing)
-        self.push()
+        updated = sorted(filter(lambda path: path in self.submodules and path in shas and gitlinks[path] != shas[path], gitlinks))
+        return collections.OrderedDict([
+            ('head', self.head()),
+            ('updated', collections.OrderedDict(map(lambda path: (path, {'from': gitlinks[path], 'to': shas[path]}), updated))),
+            ('removed', sorted(submodules_present - self.submodules)),
+            ('added', collections.OrderedDict(map(lambda path: (path, shas.get(path)), sorted(self.submodules - submodules_present)))),
+            ('quarantined', sorted(self.quarantined_submodules())),
+        ])
+
+    def timed(self, phase):
+        return metrics.time('apertium_sync_phase_seconds', metarepo=self.name, phase=phase)
+
+
+# Gitlinks and .gitmodules of bare meta repos are edited through the index and object database
+# so submodules are never cloned or checked out.
+class BareMetaRepoSyncer(MetaRepoSyncer):
+    def __init__(self, clone_dir, name, submodules, author, quarantine_ttl=DEFAULT_QUARANTINE_TTL):
+        super().__init__(clone_dir, name, submodules, author, quarantine_ttl)
+        self.dir = os.path.join(clone_dir, '{}.git'.format(name))
+        self.check_call = functools.partial(subprocess.check_call, cwd=self.dir)
+
+    def clone(self, init_submodules=True):
+        if not os.path.isdir(self.dir):
+            logging.info('Cloning bare meta repository %s', self.name)
+            subprocess.check_call(
+                ['git', 'clone', '--bare', '--depth', '1', '--filter=blob:none', remote_url(self.name), self.dir],
+                cwd=self.clone_dir, timeout=GIT_TIMEOUT,
+            )
+            self.check_call(shlex.split('git read-tree master'))
+        else:
+            logging.debug('Meta repository %s already cloned', self.name)
+
+    def pull(self):
+        self.check_call(shlex.split('git fetch --depth 1 origin +refs/heads/master:refs/heads/master'), timeout=GIT_TIMEOUT)
+        self.check_call(shlex.split('git read-tree master'))
+
+    def update(self):
+        self.pull()
+        with submodule_io():
+            heads = self.resolve_remote_heads(self.healthy_submodules())
+        return self.set_gitlinks(heads)
+
+    def write_gitmodules(self, gitmodules):
+        return self.hash_object(format_gitmodules(gitmodules))
+
+    def remove_checkouts(self, submodules):
+        pass
+
+    def commit(self, submodule_changeset, submodules_extra, submodules_missing):
+        clean = subprocess.call(shlex.split('git diff-index --cached --quiet master --'), cwd=self.dir) == 0
+        if not clean:
+            logging.info('Committing changes to meta repository %s', self.name)
+            commit_message = self.commit_message(submodule_changeset, submodules_extra, submodules_missing)
+            author_name, author_email = re.match(r'^(.*?)\s*<(.*)>$', self.author).groups()
+            env = dict(os.environ, GIT_AUTHOR_NAME=author_name, GIT_AUTHOR_EMAIL=author_email)
+            tree = subprocess.check_output(shlex.split('git write-tree'), cwd=self.dir, universal_newlines=True).strip()
+            parent = self.head()
+            commit = subprocess.check_output(
+                ['git', 'commit-tree', tree, '-p', parent, '-m', commit_message],
+                cwd=self.dir, env=env, universal_newlines=True,
+            ).strip()
+            self.check_call(['git', 'update-ref', 'refs/heads/master', commit, parent])
+        else:
+            logging.info('Meta repository %s requires no changes', self.name)
+
+    def push(self):
+        self.check_call(shlex.split('git push origin master'), timeout=GIT_TIMEOUT)
+
+    def _has_submodules(self):
+        return subprocess.call(shlex.split('git cat-file -e :.gitmodules'), cwd=self.dir, stderr=subprocess.DEVNULL) == 0
+
+
+def metarepo_syncer(args, name, submodules):
+    syncer_class = BareMetaRepoSyncer if args.bare else MetaRepoSyncer
+    return syncer_class(args.dir, name, submodules, args.author, args.quarantine_ttl)
+
+
+def is_master_push(payload):
+    return not payload.get('deleted') and payload['ref'] == 'refs/heads/master'
+
+
+def compact_payload(event, payload):
+    repository = payload['repository']
+    compact = {
+        'repository': {
+            'name': repository['name'],
+            'node_id': repository.get('node_id'),
+            'topics': repository.get('topics') or [],
+            'description': repository.get('description'),
+            'visibility': repo_visibility(repository),
+        },
+    }
+    if event == 'repository':
+        compact['action'] = payload['action']
+        if payload['action'] == 'renamed':
+            compact['changes'] = {'repository': {'name': {'from': payload['changes']['repository']['name']['from']}}}
+    return compact
+
+
+class EventJournal:
+    # Append-only log of received events, one JSON object per line. Handled deliveries are recorded
+    # by appending acknowledgements and the journal is rewritten with only the pending events
+    # whenever enough of them have accumulated.
+    MAX_SEEN_DELIVERIES = 10000
+    COMPACTION_THRESHOLD = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending = collections.OrderedDict()
+        self.seen = collections.OrderedDict()
+        self.acked_since_compaction = 0
+        self.journal_file = None
+
+    def replay(self):
+        with self.lock:
+            with contextlib.suppress(FileNotFoundError), open(self.path) as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        logging.warn('Skipping corrupt event journal entry: %s', line)
+                        continue
+                    if 'ack' in entry:
+                        for delivery in entry['ack']:
+                            self.pending.pop(delivery, None)
+                            self._see(delivery)
+                    elif entry['delivery'] not in self.seen:
+                        self.pending[entry['delivery']] = entry
+                        self._see(entry['delivery'])
+            self._compact()
+            logging.info('Replaying %d pending events from journal %s', len(self.pending), self.path)
+            return list(self.pending.values())
+
+    def append(self, record):
+        with self.lock:
+            if record['delivery'] in self.seen:
+                return False
+            self.pending[record['delivery']] = record
+            self._see(record['delivery'])
+            self._write(record)
+            return True
+
+    def ack(self, deliveries):
+        deliveries = [delivery for delivery in deliveries if delivery is not None]
+        if not deliveries:
+            return
+        with self.lock:
+            for delivery in deliveries:
+                self.pending.pop(delivery, None)
+            self._write({'ack': deliveries})
+            self.acked_since_compaction += len(deliveries)
+            if self.acked_since_compaction >= self.COMPACTION_THRESHOLD:
+                self._compact()
+
+    def _see(self, delivery):
+        self.seen[delivery] = True
+        while len(self.seen) > self.MAX_SEEN_DELIVERIES:
+            self.seen.popitem(last=False)
+
+    def _write(self, entry):
+        if self.journal_file is None:
+            self.journal_file = open(self.path, 'a')
+        self.journal_file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+
+    def _compact(self):
+        if self.journal_file is not None:
+            self.journal_file.close()
+        temp_path = '{}.tmp'.format(self.path)
+        with open(temp_path, 'w') as journal_file:
+            for record in self.pending.values():
+                journal_file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        os.replace(temp_path, self.path)
+        self.journal_file = open(self.path, 'a')
+        self.acked_since_compaction = 0
+
+
+class Snapshot:
+    # Compact listing of repositories, descriptions and topics for source-browser.html, kept
+    # compressed in memory and on disk so that it is served right after a restart.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.encodings = {}
+        self.etag = None
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as snapshot_file:
+                self._set(gzip.decompress(snapshot_file.read()))
+        except (OSError, EOFError) as error:
+            logging.info('Unable to load snapshot from %s: %s', self.path, error)
+
+    def update(self, repos):
+        content = json.dumps({'organization': ORGANIZATION, 'repos': repos}, separators=(',', ':'), sort_keys=True).encode('utf-8')
+        if self._set(content):
+            temp_path = '{}.tmp'.format(self.path)
+            with open(temp_path, 'wb') as snapshot_file:
+                snapshot_file.write(self.encodings['gzip'])
+            os.replace(temp_path, self.path)
+            logging.info('Wrote snapshot of %d repositories to %s', len(repos), self.path)
+
+    def _set(self, content):
+        etag = 'W/"{}"'.format(hashlib.sha1(content).hexdigest())
+        if etag == self.etag:
+            return False
+        encodings = {'identity': content, 'gzip': gzip.compress(content, mtime=0)}
+        if brotli:
+            encodings['br'] = brotli.compress(content)
+        with self.lock:
+            self.encodings, self.etag = encodings, etag
+        return True
+
+    def get(self, accept_encoding):
+        with self.lock:
+            encodings, etag = self.encodings, self.etag
+        accepted = set(map(lambda encoding: encoding.split(';')[0].strip(), (accept_encoding or '').split(',')))
+        encoding = next(filter(lambda encoding: encoding in accepted and encoding in encodings, ('br', 'gzip')), 'identity')
+        return encoding, encodings.get(encoding), etag
 
 
 class RequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == '/snapshot.json':
+            encoding, body, etag = self.server.snapshot.get(self.headers['Accept-Encoding'])
+            if body is None:
+                self.send_response(503)
+                self.end_headers()
+                return
+            self.send_response(304 if self.headers['If-None-Match'] == etag else 200)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'public, max-age={}'.format(SNAPSHOT_MAX_AGE))
+            self.send_header('Vary', 'Accept-Encoding')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            if self.headers['If-None-Match'] == etag:
+                self.end_headers()
+                return
+            self.send_header('Content-Type', 'application/json')
+            if encoding != 'identity':
+                self.send_header('Content-Encoding', encoding)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_response(404)
+            self.end_headers()
+
     def do_POST(self):
         try:
             length = int(self.headers['Content-Length'])
             payload = json.loads(self.rfile.read(length).decode('utf-8'))
-            logging.debug('Recieved payload:\n%s', pprint.pformat(payload, indent=2))
+            logging.debug('Recieved payload:\n%s', LazyPrettyFormat(payload))
             event = self.headers['X-Github-Event']
-            if event in {'push', 'repository'}:
-                self.server.event_queue.put(payload)
+            delivery = self.headers['X-Github-Delivery'] or str(uuid.uuid4())
+            if event == 'push' and not is_master_push(payload):
+                logging.debug('Ignoring push to %s of %s', payload['ref'], payload['repository']['name'])
+                self.send_response(200)
+            elif event in {'push', 'repository'}:
+                record = {'delivery': delivery, 'event': event, 'payload': compact_payload(event, payload), 'received': time.time()}
+                if self.server.journal.append(record):
+                    self.server.event_queue.put(record)
+                else:
+                    logging.info('Ignoring redelivery of %s', delivery)
                 self.send_response(200)
             else:
                 logging.warn('Ignoring %s event', event)
@@ -297,62 +1126,537 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
             self.end_headers()
 
 
-class Server(socketserver.TCPServer):
+class MetaRepoState:
+    def __init__(self, dependencies):
+        self.dependencies = dependencies
+        self.dirty = False
+        self.running = False
+        self.deadline = 0
+        self.shas = {}
+        self.deliveries = set()
+        self.received = None
+        self.head = None
+        self.retry_at = None
+        self.retry_submodules = set()
+        self.failures = 0
+
+    def is_busy(self, now):
+        return self.running or (self.dirty and self.deadline <= now)
+
+
+def retry_delay(failures):
+    return min(MIN_RETRY_DELAY * 2 ** (failures - 1), MAX_RETRY_DELAY)
+
+
+class SyncScheduler:
+    def __init__(self, args, topic_index, journal):
+        self.args = args
+        self.topic_index = topic_index
+        self.journal = journal
+        self.outstanding_deliveries = collections.Counter()
+        self.condition = threading.Condition()
+        self.pool = concurrent.futures.ThreadPoolExecutor()
+        self.states = collections.OrderedDict()
+        for i, metarepo_group in enumerate(METAREPOS):
+            dependencies = set(itertools.chain.from_iterable(METAREPOS[:i]))
+            for name in metarepo_group:
+                self.states[name] = MetaRepoState(dependencies)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def mark(self, name, shas=None, delay=None, deliveries=(), received=None):
+        # A None shas requests a full update, which absorbs any pending pushes.
+        with self.condition:
+            state = self.states[name]
+            if received is not None:
+                state.received = min(state.received or received, received)
+            new_deliveries = set(deliveries) - state.deliveries
+            state.deliveries |= new_deliveries
+            self.outstanding_deliveries.update(new_deliveries)
+            deadline = time.monotonic() + (self.args.sync_interval if delay is None else delay)
+            if not state.dirty:
+                state.dirty = True
+                state.deadline = deadline
+                state.shas = {}
+            else:
+                state.deadline = min(state.deadline, deadline)
+            if shas is None or state.shas is None:
+                state.shas = None
+            else:
+                state.shas.update(shas)
+            logging.debug('Marked meta repository %s dirty', name)
+            self.condition.notify()
+
+    def dirty_count(self):
+        return sum(map(lambda state: state.dirty, self.states.values()))
+
+    def run(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                timeout = None
+                for name, state in self.states.items():
+                    if state.retry_at is not None and state.retry_at <= now:
+                        state.retry_at = None
+                        self.mark(name, shas=dict.fromkeys(sorted(state.retry_submodules)), delay=0)
+                    elif state.retry_at is not None:
+                        timeout = min(timeout or state.retry_at - now, state.retry_at - now)
+                    if not state.dirty or state.running:
+                        continue
+                    if any(map(lambda dependency: self.states[dependency].is_busy(now), state.dependencies)):
+                        continue
+                    if state.deadline > now:
+                        timeout = min(timeout or state.deadline - now, state.deadline - now)
+                        continue
+                    state.dirty, state.running = False, True
+                    self.pool.submit(self.sync, name, state.shas, state.deliveries, state.received)
+                    state.deliveries, state.received = set(), None
+                self.condition.wait(timeout)
+
+    def sync(self, name, shas, deliveries, received):
+        head = None
+        quarantined = set()
+        try:
+            syncer = metarepo_syncer(self.args, name, self.topic_index.submodules(name))
+            head = syncer.sync(shas=shas)
+            quarantined = syncer.quarantined_submodules()
+            if head and received is not None:
+                metrics.observe('apertium_sync_webhook_to_push_seconds', time.time() - received, metarepo=name)
+        except Exception as error:
+            logging.error('Error while syncing meta repository %s: %s', name, error, exc_info=True)
+        finally:
+            with self.condition:
+                state = self.states[name]
+                state.running = False
+                if quarantined:
+                    # Quarantined submodules are retried on their own once their quarantine is over.
+                    state.retry_at = time.monotonic() + self.args.quarantine_ttl
+                    state.retry_submodules = quarantined
+                if head and head != state.head:
+                    state.head = head
+                    for dependent_name in self.topic_index.metarepos_for(name):
+                        self.mark(dependent_name, shas={name: head}, delay=0, deliveries=deliveries, received=received)
+                self.outstanding_deliveries.subtract(deliveries)
+                if head:
+                    state.failures = 0
+                else:
+                    # The deliveries of a failed sync stay outstanding until a retry succeeds.
+                    state.failures += 1
+                    delay = retry_delay(state.failures)
+                    logging.warn('Retrying sync of meta repository %s in %ds', name, delay)
+                    self.mark(name, shas=shas, delay=delay, deliveries=deliveries, received=received)
+                handled_deliveries = list(filter(lambda delivery: self.outstanding_deliveries[delivery] <= 0, deliveries))
+                for delivery in handled_deliveries:
+                    del self.outstanding_deliveries[delivery]
+                self.journal.ack(handled_deliveries)
+                self.condition.notify()
+
+
+class WorkQueue:
+    # Meta repo syncs shared between a server and any number of worker processes through SQLite.
+    # A worker claims a meta repo under a lease which it renews while syncing. The lease of a worker
+    # that crashed expires and the meta repo is claimed again, starting from a reset clone. Leases
+    # use wall clock time since they are compared across processes.
+    def __init__(self, path):
+        self.path = path
+        with self.transaction() as connection:
+            connection.execute(textwrap.dedent('''
+                CREATE TABLE IF NOT EXISTS metarepos (
+                    name TEXT PRIMARY KEY,
+                    submodules TEXT NOT NULL DEFAULT '[]',
+                    pending INTEGER NOT NULL DEFAULT 0,
+                    shas TEXT NOT NULL DEFAULT '{}',
+                    received REAL,
+                    not_before REAL NOT NULL DEFAULT 0,
+                    generation INTEGER NOT NULL DEFAULT 0,
+                    owner TEXT,
+                    lease_expires REAL,
+                    head TEXT,
+                    retry_at REAL,
+                    retry_submodules TEXT NOT NULL DEFAULT '[]',
+                    failures INTEGER NOT NULL DEFAULT 0
+                )
+            '''))
+            columns = set(map(lambda row: row['name'], connection.execute('PRAGMA table_info(metarepos)')))
+            for column, definition in (
+                ('retry_at', 'REAL'),
+                ('retry_submodules', "TEXT NOT NULL DEFAULT '[]'"),
+                ('failures', 'INTEGER NOT NULL DEFAULT 0'),
+            ):
+                if column not in columns:
+                    connection.execute('ALTER TABLE metarepos ADD COLUMN {} {}'.format(column, definition))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+    def register(self, name, submodules):
+        with self.transaction() as connection:
+            connection.execute('INSERT OR IGNORE INTO metarepos (name) VALUES (?)', (name,))
+            connection.execute('UPDATE metarepos SET submodules = ? WHERE name = ?', (json.dumps(sorted(submodules)), name))
+
+    def mark(self, name, submodules, shas=None, delay=0, received=None):
+        with self.transaction() as connection:
+            connection.execute('INSERT OR IGNORE INTO metarepos (name) VALUES (?)', (name,))
+            connection.execute('UPDATE metarepos SET submodules = ? WHERE name = ?', (json.dumps(sorted(submodules)), name))
+            self._mark(connection, name, shas, delay, received)
+
+    def _mark(self, connection, name, shas, delay, received):
+        # A None shas requests a full update, which absorbs any pending pushes.
+        row = connection.execute('SELECT * FROM metarepos WHERE name = ?', (name,)).fetchone()
+        pending_shas, not_before = json.loads(row['shas']), min(row['not_before'], time.time() + delay)
+        if not row['pending']:
+            pending_shas, not_before = {}, time.time() + delay
+        if shas is None or pending_shas is None:
+            pending_shas = None
+        else:
+            pending_shas.update(shas)
+        received = min(filter(lambda value: value is not None, (row['received'], received)), default=None)
+        connection.execute(
+            'UPDATE metarepos SET pending = 1, shas = ?, received = ?, not_before = ?, generation = generation + 1 WHERE name = ?',
+            (json.dumps(pending_shas), received, not_before, name),
+        )
+        logging.debug('Marked meta repository %s pending', name)
+
+    def retry(self, name, submodules, delay):
+        with self.transaction() as connection:
+            connection.execute(
+                'UPDATE metarepos SET retry_at = ?, retry_submodules = ? WHERE name = ?', (time.time() + delay, json.dumps(sorted(submodules)), name),
+            )
+
+    def pending_count(self):
+        with self.transaction() as connection:
+            return connection.execute('SELECT COUNT(*) FROM metarepos WHERE pending').fetchone()[0]
+
+    def claim(self, owner, lease_duration):
+        # Like the in-process scheduler, a meta repo is only claimed once no meta repo in an earlier
+        # dict of METAREPOS is due or leased.
+        with self.transaction() as connection:
+            now = time.time()
+            for row in connection.execute('SELECT name, retry_submodules FROM metarepos WHERE retry_at <= ?', (now,)).fetchall():
+                connection.execute('UPDATE metarepos SET retry_at = NULL WHERE name = ?', (row['name'],))
+                self._mark(connection, row['name'], dict.fromkeys(json.loads(row['retry_submodules'])), 0, None)
+            rows = dict(map(lambda row: (row['name'], row), connection.execute('SELECT * FROM metarepos')))
+
+            def is_leased(row):
+                return row['owner'] is not None and row['lease_expires'] > now
+
+            def is_busy(name):
+                return name in rows and ((rows[name]['pending'] and rows[name]['not_before'] <= now) or is_leased(rows[name]))
+
+            for i, metarepo_group in enumerate(METAREPOS):
+                dependencies = list(itertools.chain.from_iterable(METAREPOS[:i]))
+                for name in metarepo_group:
+                    row = rows.get(name)
+                    if not row or not row['pending'] or row['not_before'] > now or is_leased(row):
+                        continue
+                    if any(map(is_busy, dependencies)):
+                        continue
+                    if row['owner'] is not None:
+                        logging.warn('Lease of %s on meta repository %s expired', row['owner'], name)
+                    connection.execute('UPDATE metarepos SET owner = ?, lease_expires = ? WHERE name = ?', (owner, now + lease_duration, name))
+                    logging.info('Claimed meta repository %s', name)
+                    return dict(row)
+
+    def renew(self, name, owner, lease_duration):
+        with self.transaction() as connection:
+            return connection.execute(
+                'UPDATE metarepos SET lease_expires = ? WHERE name = ? AND owner = ?', (time.time() + lease_duration, name, owner),
+            ).rowcount == 1
+
+    def complete(self, claim, owner, head):
+        # A meta repo marked again while it was synced stays pending with the shas of both marks,
+        # re-applying a gitlink that is already set is a no-op. A failed sync stays pending and is
+        # claimed again after a backoff.
+        name = claim['name']
+        with self.transaction() as connection:
+            row = connection.execute('SELECT * FROM metarepos WHERE name = ?', (name,)).fetchone()
+            if row['owner'] != owner:
+                logging.warn('Lease on meta repository %s was lost to %s', name, row['owner'])
+                return
+            connection.execute('UPDATE metarepos SET owner = NULL, lease_expires = NULL WHERE name = ?', (name,))
+            if not head:
+                delay = retry_delay(row['failures'] + 1)
+                logging.warn('Retrying sync of meta repository %s in %ds', name, delay)
+                connection.execute(
+                    'UPDATE metarepos SET failures = failures + 1, not_before = ? WHERE name = ?', (time.time() + delay, name),
+                )
+                return
+            connection.execute('UPDATE metarepos SET failures = 0 WHERE name = ?', (name,))
+            if row['generation'] == claim['generation']:
+                connection.execute("UPDATE metarepos SET pending = 0, shas = '{}', received = NULL WHERE name = ?", (name,))
+            if head and head != row['head']:
+                connection.execute('UPDATE metarepos SET head = ? WHERE name = ?', (head, name))
+                for dependent in connection.execute('SELECT name, submodules FROM metarepos').fetchall():
+                    if name in json.loads(dependent['submodules']):
+                        self._mark(connection, dependent['name'], {name: head}, 0, claim['received'])
+
+
+class WorkQueueScheduler:
+    # Used by the server in place of SyncScheduler when syncs are left to worker processes. The
+    # queue is durable, so deliveries are acknowledged as soon as they are enqueued.
+    def __init__(self, args, topic_index, journal):
+        self.args = args
+        self.topic_index = topic_index
+        self.journal = journal
+        self.queue = WorkQueue(args.queue)
+        for metarepo_group in METAREPOS:
+            for name in metarepo_group:
+                self.queue.register(name, self.topic_index.submodules(name))
+
+    def mark(self, name, shas=None, delay=None, deliveries=(), received=None):
+        delay = self.args.sync_interval if delay is None else delay
+        self.queue.mark(name, self.topic_index.submodules(name), shas=shas, delay=delay, received=received)
+        self.journal.ack(deliveries)
+
+    def dirty_count(self):
+        return self.queue.pending_count()
+
+
+class Worker:
+    def __init__(self, args):
+        self.args = args
+        self.queue = WorkQueue(args.queue)
+
+    def run(self):
+        logging.info('Starting %d workers on work queue %s', self.args.jobs, self.args.queue)
+        threads = []
+        for i in range(self.args.jobs):
+            owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), i)
+            threads.append(threading.Thread(target=self.work, args=(owner,), daemon=True))
+            threads[-1].start()
+        for thread in threads:
+            thread.join()
+
+    def work(self, owner):
+        while True:
+            try:
+                claim = self.queue.claim(owner, self.args.lease)
+            except sqlite3.Error as error:
+                logging.error('Error while claiming from work queue: %s', error, exc_info=True)
+                claim = None
+            if claim:
+                self.sync(claim, owner)
+            else:
+                time.sleep(WORK_QUEUE_POLL_INTERVAL)
+
+    def sync(self, claim, owner):
+        name = claim['name']
+        stop_renewing = threading.Event()
+
+        def renew_lease():
+            while not stop_renewing.wait(self.args.lease / 3):
+                if not self.queue.renew(name, owner, self.args.lease):
+                    logging.warn('Unable to renew lease on meta repository %s', name)
+
+        renewer = threading.Thread(target=renew_lease, daemon=True)
+        renewer.start()
+        head = None
+        quarantined = set()
+        try:
+            syncer = metarepo_syncer(self.args, name, set(json.loads(claim['submodules'])))
+            head = syncer.sync(shas=json.loads(claim['shas']))
+            quarantined = syncer.quarantined_submodules()
+            if head and claim['received'] is not None:
+                metrics.observe('apertium_sync_webhook_to_push_seconds', time.time() - claim['received'], metarepo=name)
+        except Exception as error:
+            logging.error('Error while syncing meta repository %s: %s', name, error, exc_info=True)
+        finally:
+            stop_renewing.set()
+            renewer.join()
+            self.queue.complete(claim, owner, head)
+            if quarantined:
+                self.queue.retry(name, quarantined, self.args.quarantine_ttl)
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+
     def __init__(self, cli_args, event_queue, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.args = cli_args
         self.event_queue = event_queue
-        self.schedule_event_handler()
+        self.topic_index = TopicIndex(os.path.join(self.args.dir, TOPIC_INDEX_FILE))
+        if not self.topic_index.load():
+            self.topic_index.reconcile(self.args.token)
+        self.snapshot = Snapshot(os.path.join(self.args.dir, SNAPSHOT_FILE))
+        self.snapshot.load()
+        self.snapshot.update(self.topic_index.snapshot())
+        self.journal = EventJournal(os.path.join(self.args.dir, EVENT_JOURNAL_FILE))
+        for record in self.journal.replay():
+            self.event_queue.put(record)
+        scheduler_class = WorkQueueScheduler if self.args.queue else SyncScheduler
+        self.scheduler = scheduler_class(self.args, self.topic_index, self.journal)
+        self.language_names = None
+        self.description_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        if self.args.describe:
+            self.description_pool.submit(self.load_language_names)
+        metrics.gauge('apertium_sync_event_queue_depth', 'Number of events waiting to be scheduled.', self.event_queue.qsize)
+        metrics.gauge(
+            'apertium_sync_dirty_metarepos',
+            'Number of meta repositories waiting to be synced.',
+            self.scheduler.dirty_count,
+        )
+        metrics.gauge(
+            'apertium_sync_quarantined_submodules',
+            'Number of submodules skipped because their remote failed a probe.',
+            lambda: len(submodule_quarantine(self.args.dir).active()),
+        )
+        self.schedule_reconciliation()
+        self.event_handler_thread = threading.Thread(target=self.handle_events, daemon=True)
+        self.event_handler_thread.start()
 
-    def schedule_event_handler(self):
-        logging.debug('Scheduling next event handler')
-        self.event_handler_timer = threading.Timer(self.args.sync_interval, self.handle_events)
-        self.event_handler_timer.daemon = True
-        self.event_handler_timer.start()
+    def schedule_reconciliation(self):
+        logging.debug('Scheduling next topic index reconciliation')
+        self.reconciliation_timer = threading.Timer(self.args.reconcile_interval, self.reconcile)
+        self.reconciliation_timer.daemon = True
+        self.reconciliation_timer.start()
+
+    def reconcile(self):
+        try:
+            for name, metarepos in self.topic_index.reconcile(self.args.token).items():
+                self.event_queue.put({
+                    'delivery': None,
+                    'event': 'reconcile',
+                    'payload': {'repository': {'name': name}, 'metarepos': sorted(metarepos)},
+                    'received': time.time(),
+                })
+            self.snapshot.update(self.topic_index.snapshot())
+        except Exception as error:
+            logging.error('Error while reconciling topic index %s', error, exc_info=True)
+        finally:
+            self.schedule_reconciliation()
 
     def handle_events(self):
-        logging.info('Waiting for an event')
-        events = []
-        events.append(self.event_queue.get())
+        while True:
+            logging.info('Waiting for an event')
+            events = [self.event_queue.get()]
+            while True:
+                try:
+                    events.append(self.event_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self.schedule_events(events)
+            except Exception as error:
+                logging.error('Error while handling events %s', error, exc_info=True)
+            finally:
+                for _ in events:
+                    self.event_queue.task_done()
+
+    def schedule_events(self, events):
+        # Events are routed through the topic index to the meta repos that contain their repository.
+        # Deliveries arrive in any order and branches can be force-pushed, so a push only records that
+        # its repository changed and the syncer sets the gitlink to the head it lists at sync time.
+        # Reconciliations fall back to a full update, fetching every submodule into the shared cache
+        # repo or, for bare clones, listing their heads with `git ls-remote`.
+        shas = collections.OrderedDict()
+        deliveries = collections.defaultdict(set)
+        received = {}
+        unrouted_deliveries = set()
+        for event in events:
+            name, delivery = event['payload']['repository']['name'], event['delivery']
+            metarepos = self.topic_index.apply_event(event['event'], event['payload'])
+            logging.debug('Event %s for %s concerns meta repositories %s', event['event'], name, metarepos)
+            if not metarepos:
+                unrouted_deliveries.add(delivery)
+            for metarepo in metarepos:
+                metarepo_shas = shas.setdefault(metarepo, {})
+                if event['event'] == 'reconcile':
+                    shas[metarepo] = None
+                elif event['event'] == 'push' and metarepo_shas is not None:
+                    metarepo_shas[name] = None
+                deliveries[metarepo].add(delivery)
+                received[metarepo] = min(received.get(metarepo, event['received']), event['received'])
+        metrics.observe('apertium_sync_events_per_batch', len(events))
+        logging.debug('Got %d events concerning meta repositories: %s', len(events), list(shas.keys()))
+        for metarepo, metarepo_shas in shas.items():
+            self.scheduler.mark(metarepo, shas=metarepo_shas, deliveries=deliveries[metarepo] - {None}, received=received[metarepo])
+        self.journal.ack(unrouted_deliveries)
 
-        while not self.event_queue.empty():
-            with contextlib.suppress(queue.Empty):
-                events.append(self.event_queue.get_nowait())
-                self.event_queue.task_done()
+        if any(map(lambda event: event['event'] == 'repository', events)):
+            self.snapshot.update(self.topic_index.snapshot())
+            self.describe_repos(events)
 
+    def describe_repos(self, events):
+        # Created or edited repos still lacking a description get one in a single batched mutation,
+        # sent from its own thread since the client may wait out rate limits. Our own update comes
+        # back as an edited event that carries the description and is skipped.
+        if self.language_names is None:
+            return
+        repos = collections.OrderedDict()
+        for event in filter(lambda event: event['event'] == 'repository' and event['payload']['action'] in {'created', 'edited'}, events):
+            repository = event['payload']['repository']
+            if repository['description'] is not None or not repository.get('node_id'):
+                repos.pop(repository['name'], None)
+                continue
+            description = description_for(repository['name'], repository['topics'], self.language_names)
+            if description:
+                logging.info('Describing %s as %s', repository['name'], repr(description))
+                repos[repository['name']] = (repository['node_id'], repository['name'], description)
+            else:
+                repos.pop(repository['name'], None)
+        if repos:
+            self.description_pool.submit(self.describe, list(repos.values()))
+
+    def load_language_names(self):
+        # Loaded off the constructor so a slow APy does not hold up the server, repos created or
+        # edited until then are left undescribed.
         try:
-            affected_repos = set(map(lambda event: event['repository']['name'], events))
-            logging.debug('Got %d events representing %d repositories: %s', len(events), len(affected_repos), affected_repos)
+            self.language_names = load_language_names(self.args.apy_url, DEFAULT_LANGUAGE_NAMES_CACHE)
+        except Exception as error:
+            logging.error('Unable to load language names, new repositories will not be described: %s', error, exc_info=True)
 
-            logging.info('Starting meta repository sync')
-            repos = list_repos(self.args.token)
-            repos_by_topic = group_repos_by_topic(repos)
-            for i, metarepo_group in enumerate(METAREPOS):
-                later_metarepos = set(sum(list(map(lambda group: list(group.keys()), METAREPOS[i + 1:])), []))
-                relevant_affected_repos = affected_repos - (later_metarepos | set(metarepo_group.keys()))
-                if relevant_affected_repos:
-                    logging.debug('Relevant affected repositories for group %d are: %s', i, relevant_affected_repos)
-                    with concurrent.futures.ThreadPoolExecutor() as pool:
-                        for name, topics in metarepo_group.items():
-                            submodules = repos_for_topics(repos_by_topic, topics)
-                            pool.submit(MetaRepoSyncer(self.args.dir, name, submodules, self.args.author).sync)
-                else:
-                    logging.debug('Ignoring events for meta repository group %d', i)
+    def describe(self, repos):
+        try:
+            describe(shared_client(self.args.token, GITHUB_API), repos)
         except Exception as error:
-            logging.error('Error while handling events %s', error, exc_info=True)
-        finally:
-            self.event_queue.task_done()
-            self.schedule_event_handler()
+            logging.error('Error while describing %s: %s', ', '.join(map(lambda repo: repo[1], repos)), error, exc_info=True)
 
     def server_bind(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind(self.server_address)
+        self.server_address = self.socket.getsockname()
 
     def server_close(self):
-        self.event_handler_timer.cancel()
+        self.reconciliation_timer.cancel()
         super().server_close()
 
 
+def sync_metarepos(args):
+    # The desired gitlinks are the master heads listed along with the topics, so a full
+    # sync costs a few API pages plus one commit per meta repo and never fetches a submodule.
+    repos = list(iter_repos(args.token, extra_nodes=MASTER_HEAD_NODES))
+    repos_by_topic = group_repos_by_topic(repos)
+    shas = master_heads(repos)
+    plans = collections.OrderedDict()
+    for metarepo_group in METAREPOS:
+        for name, topics in metarepo_group.items():
+            if args.repo and name != args.repo:
+                continue
+            submodules = repos_for_topics(repos_by_topic, topics) & shas.keys()
+            syncer = metarepo_syncer(args, name, submodules)
+            if args.dry_run:
+                plans[name] = syncer.plan(shas)
+            else:
+                head = syncer.sync(shas=shas)
+                if head:
+                    shas[name] = head
+    return plans
+
+
 def start_server(args):
     global server
     logging.info('Starting server on port %d', args.port)
@@ -361,21 +1665,64 @@ def start_server(args):
     server.serve_forever()
 
 
-def main():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='Sync Apertium meta repositories.')
     parser.add_argument(
         'action',
-        choices={'startserver', 'sync'},
-        help='use "startserver" to start the server and "sync --repo [name]" to force a meta-repo sync',
+        choices={'startserver', 'sync', 'worker'},
+        help='use "startserver" to start the server, "sync --repo [name]" to force a meta-repo sync and "worker" to sync meta repos from --queue',
     )
     parser.add_argument('--verbose', '-v', action='count', help='add verbosity (maximum -vv)', default=0)
     parser.add_argument('--dir', '-d', help='directory to clone meta repos', default=DEFAULT_CLONE_DIR)
     parser.add_argument('--repo', '-r', help='meta-repo to sync (default: all)', choices=list(collections.ChainMap(*METAREPOS).keys()))
     parser.add_argument('--port', '-p', type=int, help='server port (default: {})'.format(DEFAULT_PORT), default=DEFAULT_PORT)
     parser.add_argument('--token', '-t', help='GitHub OAuth token', required=(DEFAULT_OAUTH_TOKEN is None), default=DEFAULT_OAUTH_TOKEN)
-    parser.add_argument('--sync-interval', '-i', help='min interval between syncs (default: {}s)'.format(DEFAULT_SYNC_INTERVAL), default=DEFAULT_SYNC_INTERVAL)
+    parser.add_argument(
+        '--sync-interval',
+        '-i',
+        type=float,
+        help='min interval between syncs (default: {}s)'.format(DEFAULT_SYNC_INTERVAL),
+        default=DEFAULT_SYNC_INTERVAL,
+    )
+    parser.add_argument(
+        '--reconcile-interval',
+        type=int,
+        help='interval between full topic index reconciliations (default: {}s)'.format(DEFAULT_RECONCILE_INTERVAL),
+        default=DEFAULT_RECONCILE_INTERVAL,
+    )
+    parser.add_argument('--bare', '-b', action='store_true', help='sync bare meta repo clones without checking out any submodules')
     parser.add_argument('--author', '-a', help='commit author (default: {})'.format(DEFAULT_AUTHOR), default=DEFAULT_AUTHOR)
-    args = parser.parse_args()
+    parser.add_argument(
+        '--queue',
+        '-q',
+        help='SQLite work queue; the server only enqueues syncs for workers when set (default for worker: DIR/{})'.format(WORK_QUEUE_FILE),
+    )
+    parser.add_argument(
+        '--lease',
+        type=int,
+        help='seconds a worker holds a meta repo without renewing its lease (default: {}s)'.format(DEFAULT_LEASE_DURATION),
+        default=DEFAULT_LEASE_DURATION,
+    )
+    parser.add_argument(
+        '--quarantine-ttl',
+        type=int,
+        help='seconds submodules whose remote failed a probe are skipped before being retried (default: {}s)'.format(DEFAULT_QUARANTINE_TTL),
+        default=DEFAULT_QUARANTINE_TTL,
+    )
+    parser.add_argument('--jobs', '-j', type=int, help='meta repos a worker syncs concurrently (default: 1)', default=1)
+    parser.add_argument('--dry-run', '-n', action='store_true', help='print the sync plan of each meta repo as JSON without committing')
+    parser.add_argument(
+        '--no-describe',
+        dest='describe',
+        action='store_false',
+        help='do not describe created or edited language module and pair repos lacking a description',
+    )
+    parser.add_argument('--apy-url', help='Apertium APy URL for language names (default: {})'.format(DEFAULT_APY_URL), default=DEFAULT_APY_URL)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
 
     levels = [logging.WARNING, logging.INFO, logging.DEBUG]
     logging.basicConfig(
@@ -387,18 +1734,13 @@ def main():
 
     if args.action == 'startserver':
         start_server(args)
+    elif args.action == 'worker':
+        args.queue = args.queue or os.path.join(args.dir, WORK_QUEUE_FILE)
+        Worker(args).run()
     elif args.action == 'sync':
-        repos = list_repos(args.token)
-        repos_by_topic = group_repos_by_topic(repos)
-        if args.repo:
-            topics = collections.ChainMap(*METAREPOS)[args.repo]
-            submodules = repos_for_topics(repos_by_topic, topics)
-            MetaRepoSyncer(args.dir, args.repo, submodules, args.author).sync()
-        else:
-            for metarepo_group in METAREPOS:
-                for name, topics in metarepo_group.items():
-                    submodules = repos_for_topics(repos_by_topic, topics)
-                    MetaRepoSyncer(args.dir, name, submodules, args.author).sync()
+        plans = sync_metarepos(args)
+        if args.dry_run:
+            print(json.dumps(plans, indent=2))
 
 
 if __name__ == '__main__':